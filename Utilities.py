@@ -1,14 +1,27 @@
-from math import sin, atan2, cos, acos
-import math
-from re import X
 import struct
-from typing import List
+from collections.abc import Sequence
+
+import numpy as np
+
+try:
+    from . import normals
+    from .schema import Array, Record, Schema, String
+except ImportError:
+    # loaded outside of blender, see batch_md3.py
+    import normals
+    from schema import Array, Record, Schema, String
 
 MAX_QPATH: int = 64
 MD3_MAX_FRAMES: int = 1024
 MD3_MAX_TAGS: int = 16
 MD3_MAX_SURFACES: int = 32
 MD3_XYZ_SCALE: float = (1.0/64.0)
+MD3_IDENT: int = 860898377  # "IDP3"
+MD3_VERSION: int = 15
+
+S16 = struct.Struct('<h')
+S32 = struct.Struct('<i')
+F32 = struct.Struct('<f')
 
 # Functions Start Here
 
@@ -16,110 +29,152 @@ MD3_XYZ_SCALE: float = (1.0/64.0)
 
 
 def readS16(f) -> int:
-    return struct.unpack('<h', f.read(2))[0]
+    return S16.unpack(f.read(2))[0]
 
 
 def readS32(f) -> int:
-    return struct.unpack('<i', f.read(4))[0]
+    return S32.unpack(f.read(4))[0]
 
 
 def readF32(f) -> float:
-    return struct.unpack('f', f.read(4))[0]
+    return F32.unpack(f.read(4))[0]
 
 
 def readmax(f, n) -> str:
-    str = b''
-    for _ in range(n):
-        tmp = f.read(1)
-        if tmp != '\x00':
-            str = str+tmp  # .decode('ascii')
-    return str.decode("utf-8")
+    return f.read(n).split(b'\x00', 1)[0].decode("utf-8")
+
+
+def readArray(f, dtype, count) -> np.ndarray:
+    # read a whole section at once and view it as structured records
+    buf = bytearray(dtype.itemsize * count)
+    if f.readinto(buf) != len(buf):
+        raise EOFError("unexpected end of file while reading MD3 data")
+    return np.frombuffer(buf, dtype)
 
 # WRITING FUNCTIONS
 
 
 def writeS32(f, x):
-    f.write(struct.pack('<i', x))
+    f.write(S32.pack(x))
 
 
 def writeF32(f, x):
-    f.write(struct.pack('f', x))
+    f.write(F32.pack(x))
 
 
 def writeS16(f, x):
-    f.write(struct.pack('<h', x))
+    f.write(S16.pack(x))
 
 
 def writemax(f, str, n):
     # print("writing max string:", str)
-    for _ in range(n):
-        if len(str) == 0:
-            f.write(b'\x00')
-        else:
-            f.write(str[0:1])
-            str = str[1:]
+    f.write(str[:n].ljust(n, b'\x00'))
+
+
+def packArray(buf, offset, array) -> int:
+    # copy an array into a preallocated buffer, return the offset after it
+    data = memoryview(np.ascontiguousarray(array)).cast('B')
+    buf[offset:offset + len(data)] = data
+    return offset + len(data)
+
+
+def packVertices(positions, norms) -> np.ndarray:
+    # (..., 3) quantized positions and (..., 3) normals broadcastable to
+    # them -> (..., 4) int16 xyznormal records
+    positions = np.asarray(positions)
+    xyz = np.empty(positions.shape[:-1] + (4,), '<i2')
+    xyz[..., :3] = positions
+    xyz[..., 3] = normals.encodeNormals(norms)
+    return xyz
+
+
+class RecordView(Sequence):
+    # read-only sequence building one record object per array row on access
+    def __init__(self, array, factory) -> None:
+        self.array = array
+        self.factory = factory
 
+    def __len__(self) -> int:
+        return len(self.array)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.factory(row) for row in self.array[index]]
+        return self.factory(self.array[index])
+
+
+# RECORDS, every one is read and written through its compiled SCHEMA
+
+
+class Vec3(Record):
+    SCHEMA = Schema(('x', 'i'), ('y', 'i'), ('z', 'i'))
+    __slots__ = ('x', 'y', 'z')
 
-class Vec3:
     def __init__(self, x, y, z) -> None:
         self.x: int = x
         self.y: int = y
         self.z: int = z
 
-    def read(f):
-        return Vec3(readS32(f), readS32(f), readS32(f))
 
-    def write(self, f):
-        writeS32(f, self.x)
-        writeS32(f, self.y)
-        writeS32(f, self.z)
+class Vec3f(Record):
+    SCHEMA = Schema(('x', 'f'), ('y', 'f'), ('z', 'f'))
+    __slots__ = ('x', 'y', 'z')
 
+    def __init__(self, x, y, z) -> None:
+        self.x: float = x
+        self.y: float = y
+        self.z: float = z
+
+
+class Shader(Record):
+    SCHEMA = Schema(('name', String(MAX_QPATH)), ('shader_index', 'i'))
+    __slots__ = ('name', 'shader_index')
 
-class Shader:
     def __init__(self, name, shader_index) -> None:
         self.name: str = name
         self.shader_index: int = shader_index
         # print("    shader index : ", shader_index)
         # print("    shader name : ", name)
 
-    def read(f):
-        return Shader(readmax(f, MAX_QPATH), readS32(f))
-
-    def write(self, f):
-        # print("position write: ", f.tell())
-        writemax(f, self.name.encode("utf-8"), MAX_QPATH)
-        writeS32(f, self.shader_index)
 
+class Triangle(Record):
+    # the winding is reversed between blender and the file
+    SCHEMA = Schema(('a', 'i'), ('c', 'i'), ('b', 'i'))
+    __slots__ = ('indexes',)
 
-class Triangle:
     def __init__(self, indexes) -> None:
         self.indexes: list[int] = indexes
 
-    def read(f):
-        a = readS32(f)
-        c = readS32(f)
-        b = readS32(f)
+    @classmethod
+    def fromValues(cls, values):
+        a, c, b = values
         return Triangle([a, b, c])
 
-    def write(self, f):
-        writeS32(f, self.indexes[0])
-        writeS32(f, self.indexes[2])
-        writeS32(f, self.indexes[1])
+    def values(self) -> list:
+        return [self.indexes[0], self.indexes[2], self.indexes[1]]
 
 
-class TexCoord:
+class TexCoord(Record):
+    # t is flipped between blender and the file
+    SCHEMA = Schema(('s', 'f'), ('t', 'f'))
+    __slots__ = ('st',)
+
     def __init__(self, st) -> None:
         self.st: list[float] = st
 
-    def read(f):
-        return TexCoord([readF32(f), 1.0-readF32(f)])
+    @classmethod
+    def fromValues(cls, values):
+        s, t = values
+        return TexCoord([s, 1.0-t])
+
+    def values(self) -> list:
+        return [self.st[0], 1-self.st[1]]
 
-    def write(self, f):
-        writeF32(f, self.st[0])
-        writeF32(f, 1-self.st[1])
 
+class Vertex(Record):
+    SCHEMA = Schema(('x', 'h'), ('y', 'h'), ('z', 'h'), ('normal', 'h'))
+    __slots__ = ('x', 'y', 'z', 'normal')
 
-class Vertex:
     def __init__(self, x, y, z, normal) -> None:
         # print(x, y, z, normal)
         self.x: int = x
@@ -128,34 +183,27 @@ class Vertex:
         self.normal: list[float] = normal
         # print("normal: ", self.normal)
 
-    def read(f):
-        x = readS16(f)
-        y = readS16(f)
-        z = readS16(f)
-        oldNorm = readS16(f)
-        #print("oldNorm: ", oldNorm)
-        long = ((oldNorm % 256.0)/255.0)*(2*math.pi)
-        lat = ((oldNorm/256.0)/255.0)*(2*math.pi)
-        norm = [cos(lat)*sin(long), sin(lat)*sin(long), cos(long)]
-        return Vertex(x, y, z, norm)
+    @classmethod
+    def fromValues(cls, values):
+        x, y, z, oldNorm = values
+        return Vertex(x, y, z, Vertex.unpackNormal(oldNorm))
+
+    def values(self) -> list:
+        return [self.x, self.y, self.z, self.packNormal()]
+
+    def unpackNormal(oldNorm):
+        return normals.DECODE_TABLE[oldNorm & 0xffff].tolist()
+
+    def packNormal(self) -> int:
+        return int(normals.encodeNormals(list(self.normal)))
+
+
+class Frame(Record):
+    SCHEMA = Schema(('MIN_BOUNDS', Vec3), ('MAX_BOUNDS', Vec3),
+                    ('LOCAL_ORIGIN', Vec3), ('RADIUS', 'f'),
+                    ('NAME', String(16)))
+    __slots__ = ('MIN_BOUNDS', 'MAX_BOUNDS', 'LOCAL_ORIGIN', 'RADIUS', 'NAME')
 
-    def write(self, f):
-        writeS16(f, self.x)
-        writeS16(f, self.y)
-        writeS16(f, self.z)
-        # print(self.normal)
-        
-        oldNorm = int(round(255.0*(atan2(self.normal[1],
-                                         self.normal[0])/(2*math.pi))))
-        oldNorm += int(round(255.0*(acos(self.normal[2])/(2*math.pi))))*256
-        if self.normal[2]==-1:
-            oldNorm = 32767
-        if self.normal[2]==1:
-            oldNorm = 0
-        writeS16(f, oldNorm)
-
-
-class Frame:
     def __init__(self, min_bounds, max_bounds,
                  local_origin, radius, name) -> None:
         self.MIN_BOUNDS: Vec3 = min_bounds
@@ -165,37 +213,62 @@ class Frame:
         self.NAME: str = name
         # print("    frame name : ", name)
 
-    def read(f):
-        return Frame(Vec3.read(f), Vec3.read(f), Vec3.read(f), readF32(f),
-                     readmax(f, 16))
 
-    def write(self, f):
-        self.MIN_BOUNDS.write(f)
-        self.MAX_BOUNDS.write(f)
-        self.LOCAL_ORIGIN.write(f)
-        writeF32(f, self.RADIUS)
-
-        writemax(f, self.NAME.encode("utf-8"), 16)
+class Tag(Record):
+    # the origin and the axes of a tag are floats, in model units
+    SCHEMA = Schema(('NAME', String(MAX_QPATH)), ('ORIGIN', Vec3f),
+                    ('AXIS_ROTATION', Array(Vec3f, 3)))
+    __slots__ = ('NAME', 'ORIGIN', 'AXIS_ROTATION')
 
+    def __init__(self, name, origin, axis_rotation) -> None:
+        self.NAME: str = name
+        self.ORIGIN: Vec3f = origin
+        self.AXIS_ROTATION: list[Vec3f] = axis_rotation
+
+
+class Header(Record):
+    SCHEMA = Schema(('IDENT', 'i'), ('VERSION', 'i'),
+                    ('NAME', String(MAX_QPATH)), ('FLAGS', 'i'),
+                    ('NUM_FRAMES', 'i'), ('NUM_TAGS', 'i'),
+                    ('NUM_SURFACES', 'i'), ('NUM_SKINS', 'i'),
+                    ('OFS_FRAMES', 'i'), ('OFS_TAGS', 'i'),
+                    ('OFS_SURFACES', 'i'), ('OFS_EOF', 'i'))
+    __slots__ = tuple(SCHEMA.names)
+
+    def __init__(self, ident, version, name, flags, num_frames, num_tags,
+                 num_surfaces, num_skins, ofs_frames, ofs_tags, ofs_surfaces,
+                 ofs_eof) -> None:
+        self.IDENT: int = ident
+        self.VERSION: int = version
+        self.NAME: str = name
+        self.FLAGS: int = flags
+        self.NUM_FRAMES: int = num_frames
+        self.NUM_TAGS: int = num_tags
+        self.NUM_SURFACES: int = num_surfaces
+        self.NUM_SKINS: int = num_skins
+        self.OFS_FRAMES: int = ofs_frames
+        self.OFS_TAGS: int = ofs_tags
+        self.OFS_SURFACES: int = ofs_surfaces
+        self.OFS_EOF: int = ofs_eof
 
-class Tag:
-    def __init__(self, origin, axis_rotation, name) -> None:
-        self.NAME = name
-        self.ORIGIN = origin
-        self.AXIS_ROTATION = axis_rotation
 
-    def read(f):
-        return Tag(readmax(f, MAX_QPATH), Vec3.read(f),
-                   [Vec3.read(f), Vec3.read(f), Vec3.read(f)])
+# Structured layouts of the bulk surface sections, in file order
 
-    def write(self, f):
-        writemax(f, self.NAME.encode("utf-8"), MAX_QPATH)
-        self.ORIGIN.write(f)
-        for i in range(3):
-            self.AXIS_ROTATION[i].write(f)
+SHADER_DTYPE: np.dtype = Shader.SCHEMA.dtype
+TRIANGLE_DTYPE: np.dtype = Triangle.SCHEMA.dtype
+TEXCOORD_DTYPE: np.dtype = TexCoord.SCHEMA.dtype
+VERTEX_DTYPE: np.dtype = Vertex.SCHEMA.dtype
+FRAME_DTYPE: np.dtype = Frame.SCHEMA.dtype
+TAG_DTYPE: np.dtype = Tag.SCHEMA.dtype
 
 
 class Surface:
+    HEADER = Schema(('IDENT', 'i'), ('NAME', String(MAX_QPATH)), ('FLAGS', 'i'),
+                    ('NUM_FRAMES', 'i'), ('NUM_SHADERS', 'i'),
+                    ('NUM_VERTS', 'i'), ('NUM_TRIANGLES', 'i'),
+                    ('OFS_TRIANGLES', 'i'), ('OFS_SHADERS', 'i'),
+                    ('OFS_ST', 'i'), ('OFS_XYZNORMAL', 'i'), ('OFS_END', 'i'))
+
     def __init__(self, ident, name, flags, num_frames, num_shaders, num_verts,
                  num_triangles, ofs_triangles, ofs_shaders, ofs_st,
                  ofs_xyznormal, ofs_end, shaders, triangles, sts,
@@ -219,157 +292,222 @@ class Surface:
         self.OFS_XYZNORMAL: int = ofs_xyznormal
         self.OFS_END: int = ofs_end
         self.shaders: list[Shader] = shaders
-        self.triangles: list[Triangle] = triangles
-        self.st: list[TexCoord] = sts
-        self.xyzs: List[list[Vertex]] = xyzs
+        # the data is stored as contiguous arrays in file layout,
+        # triangles, st and xyzs are built from them on access
+        self.triangles = triangles
+        self.st = sts
+        self.xyzs = xyzs
+        self.frame_source = None
+
+    @property
+    def triangles(self) -> Sequence:
+        return RecordView(self.triangle_array, Triangle.fromArray)
+
+    @triangles.setter
+    def triangles(self, triangles):
+        if isinstance(triangles, np.ndarray):
+            self.triangle_array = triangles.astype('<i4', copy=False)
+            return
+        self.triangle_array = np.array(
+            [tri.values() for tri in triangles], '<i4').reshape(-1, 3)
+
+    @property
+    def st(self) -> Sequence:
+        return RecordView(self.st_array, TexCoord.fromArray)
+
+    @st.setter
+    def st(self, sts):
+        if isinstance(sts, np.ndarray):
+            self.st_array = sts.astype('<f4', copy=False)
+            return
+        self.st_array = np.array(
+            [(st if st is not None else TexCoord([0.0, 0.0])).values()
+             for st in sts], '<f4').reshape(-1, 2)
+
+    @property
+    def xyzs(self) -> Sequence:
+        return RecordView(self.xyz_array,
+                          lambda frame: RecordView(frame, Vertex.fromArray))
+
+    @xyzs.setter
+    def xyzs(self, xyzs):
+        if isinstance(xyzs, np.ndarray):
+            self.xyz_array = xyzs.astype('<i2', copy=False)
+            return
+        num_verts = len(xyzs[0]) if len(xyzs) > 0 else 0
+        blank = Vertex(0, 0, 0, [0.0, 0.0, 1.0])
+        verts = [vert if vert is not None else blank
+                 for xyz in xyzs for vert in xyz]
+        positions = np.array([[vert.x, vert.y, vert.z] for vert in verts],
+                             np.int32).reshape(len(xyzs), num_verts, 3)
+        norms = np.array([list(vert.normal) for vert in verts],
+                         np.float64).reshape(len(xyzs), num_verts, 3)
+        self.setFrames(positions, norms)
+
+    def setFrames(self, positions, norms):
+        # (num_frames, num_verts, 3) quantized positions and float normals,
+        # the normals of every frame are encoded at once
+        self.xyz_array = packVertices(positions, norms)
+
+    def frame(self, index) -> np.ndarray:
+        # (num_verts, 4) x, y, z, normal, like LazySurface.frame
+        return self.xyz_array[index]
+
+    def frameNormals(self, frame) -> np.ndarray:
+        return normals.decodeNormals(self.xyz_array[frame, :, 3])
+
+    def headerValues(self) -> list:
+        return [getattr(self, name) for name in Surface.HEADER.names]
 
     def read(f, ofs_surface):
-        ident = readS32(f)
-        name = readmax(f, MAX_QPATH)
-        flags = readS32(f)
+        header = Surface.HEADER.unpackFrom(f.read(Surface.HEADER.size))
+        (ident, name, flags, num_frames, num_shaders, num_verts,
+         num_triangles, ofs_triangles, ofs_shaders, ofs_st, ofs_xyznormal,
+         ofs_end) = header
         # print("surface name:", name)
         # print("Model flags : ", flags)
-        num_frames = readS32(f)
-        num_shaders = readS32(f)
-        num_verts = readS32(f)
-        num_triangles = readS32(f)
-        ofs_triangles = readS32(f)
-        ofs_shaders = readS32(f)
-        ofs_st = readS32(f)
-        ofs_xyznormal = readS32(f)
-        ofs_end = readS32(f)
-        # print("     ofs shaders: ", ofs_shaders+ofs_surface)
+        # every section is decoded with a single read
         f.seek(ofs_shaders+ofs_surface)
-        shaders = []
-        for _ in range(num_shaders):
-            shaders.append(Shader.read(f))
-        # print("     ofs triangles", ofs_triangles+ofs_surface)
+        shaders = Shader.unpackArray(f.read(num_shaders*Shader.SIZE), 0,
+                                     num_shaders)
         f.seek(ofs_triangles+ofs_surface)
-        triangles = []
-        for _ in range(num_triangles):
-            triangles.append(Triangle.read(f))
-        # print("     ofs st", ofs_st+ofs_surface)
+        triangles = readArray(f, TRIANGLE_DTYPE, num_triangles) \
+            .view('<i4').reshape(num_triangles, 3)
         f.seek(ofs_st+ofs_surface)
-        sts = []
-        for _ in range(num_verts):
-            sts.append(TexCoord.read(f))
-        # print("     ofs xyznormal", ofs_xyznormal+ofs_surface)
+        sts = readArray(f, TEXCOORD_DTYPE, num_verts) \
+            .view('<f4').reshape(num_verts, 2)
         f.seek(ofs_xyznormal+ofs_surface)
-        xyzs = []
-        for _ in range(num_frames):
-            tmp = []
-            for _ in range(num_verts):
-                tmp.append(Vertex.read(f))
-            xyzs.append(tmp)
+        xyzs = readArray(f, VERTEX_DTYPE, num_frames*num_verts) \
+            .view('<i2').reshape(num_frames, num_verts, 4)
 
         # print("     ofs end", ofs_end+ofs_surface)
-        return Surface(ident, name, flags, num_frames, num_shaders, num_verts,
-                       num_triangles, ofs_triangles, ofs_shaders, ofs_st,
-                       ofs_xyznormal, ofs_end, shaders, triangles, sts, xyzs)
+        return Surface(*header, shaders, triangles, sts, xyzs)
 
     def write(self, f):
-        writeS32(f, self.IDENT)
-        writemax(f, self.NAME.encode("utf-8"), MAX_QPATH)
-        writeS32(f, self.FLAGS)
-        writeS32(f, self.NUM_FRAMES)
-        writeS32(f, self.NUM_SHADERS)
-        writeS32(f, self.NUM_VERTS)
-        writeS32(f, self.NUM_TRIANGLES)
-        writeS32(f, self.OFS_TRIANGLES)
-        writeS32(f, self.OFS_SHADERS)
-        writeS32(f, self.OFS_ST)
-        writeS32(f, self.OFS_XYZNORMAL)
-        writeS32(f, self.OFS_END)
+        f.write(Surface.HEADER.pack(self.headerValues()))
 
         # print("offset shaders: ", self.OFS_SHADERS)
         # print("offset triangles: ", self.OFS_TRIANGLES)
 
-        for triangle in self.triangles:
-            triangle.write(f)
+        f.write(self.triangle_array.tobytes())
 
         for shader in self.shaders:
             shader.write(f)
 
-        for st in self.st:
-            st.write(f)
-
-        for xyz in self.xyzs:
-            for vert in xyz:
-                vert.write(f)
+        f.write(self.st_array.tobytes())
+        f.write(self.xyz_array.tobytes())
+
+    def layout(self) -> int:
+        # compute the section offsets from the counts, return the total size
+        self.NUM_SHADERS = len(self.shaders)
+        self.NUM_TRIANGLES = len(self.triangle_array)
+        if self.frame_source is None:
+            self.NUM_FRAMES, self.NUM_VERTS = self.xyz_array.shape[:2]
+        self.OFS_TRIANGLES = Surface.HEADER.size
+        self.OFS_SHADERS = self.OFS_TRIANGLES \
+            + self.NUM_TRIANGLES*TRIANGLE_DTYPE.itemsize
+        self.OFS_ST = self.OFS_SHADERS + self.NUM_SHADERS*Shader.SIZE
+        self.OFS_XYZNORMAL = self.OFS_ST \
+            + self.NUM_VERTS*TEXCOORD_DTYPE.itemsize
+        self.OFS_END = self.OFS_XYZNORMAL \
+            + self.NUM_FRAMES*self.NUM_VERTS*VERTEX_DTYPE.itemsize
+        return self.OFS_END
+
+    def setFrameSource(self, num_frames, num_verts, source):
+        # stream the vertex data instead of holding it: source() must yield
+        # num_frames (num_verts, 4) int16 blocks, it is only iterated while
+        # the surface is written
+        self.NUM_FRAMES = num_frames
+        self.NUM_VERTS = num_verts
+        self.xyz_array = np.zeros((0, num_verts, 4), '<i2')
+        self.frame_source = source
+
+    def writeFrames(self, f):
+        count = 0
+        for block in self.frame_source():
+            block = np.ascontiguousarray(block, '<i2')
+            if block.shape != (self.NUM_VERTS, 4):
+                raise ValueError("frame block of %s has shape %s instead of "
+                                 "(%d, 4)" % (self.NAME, block.shape,
+                                              self.NUM_VERTS))
+            f.write(memoryview(block).cast('B'))
+            count += 1
+        if count != self.NUM_FRAMES:
+            raise ValueError("%s streamed %d frames instead of %d"
+                             % (self.NAME, count, self.NUM_FRAMES))
+
+    def packHeaderInto(self, buf, offset):
+        # everything but the vertex data, offsets from layout()
+        Surface.HEADER.packInto(buf, offset, self.headerValues())
+        packArray(buf, offset + self.OFS_TRIANGLES, self.triangle_array)
+        for i, shader in enumerate(self.shaders):
+            shader.packInto(buf, offset + self.OFS_SHADERS + i*Shader.SIZE)
+        packArray(buf, offset + self.OFS_ST, self.st_array)
+
+    def packInto(self, buf, offset):
+        # the offsets must be computed by layout() beforehand
+        self.packHeaderInto(buf, offset)
+        packArray(buf, offset + self.OFS_XYZNORMAL, self.xyz_array)
 
     def writeWithoutOFS(self, f):
-        start = f.tell()
-        current_position = 0
-        writeS32(f, self.IDENT)
-        writemax(f, self.NAME.encode("utf-8"), MAX_QPATH)
-        writeS32(f, self.FLAGS)
-        writeS32(f, self.NUM_FRAMES)
-        writeS32(f, self.NUM_SHADERS)
-        writeS32(f, self.NUM_VERTS)
-        writeS32(f, self.NUM_TRIANGLES)
-
-        OFS_OFS_TRIANGLE = f.tell()  # REMEMBER THE POSITION FOR FUTURE EDIT
-        writeS32(f, self.OFS_TRIANGLES)
-
-        OFS_OFS_SHADERS = f.tell()  # REMEMBER THE POSITION FOR FUTURE EDIT
-        writeS32(f, self.OFS_SHADERS)
-
-        OFS_OFS_ST = f.tell()  # REMEMBER THE POSITION FOR FUTURE EDIT
-        writeS32(f, self.OFS_ST)
-
-        OFS_OFS_XYZ = f.tell()  # REMEMBER THE POSITION FOR FUTURE EDIT
-        writeS32(f, self.OFS_XYZNORMAL)
-
-        OFS_OFS_END = f.tell()  # REMEMBER THE POSITION FOR FUTURE EDIT
-        writeS32(f, self.OFS_END)
-
-        current_position = f.tell()
-        f.seek(OFS_OFS_TRIANGLE)
-        # print("     offset triangles: ", current_position)
-        writeS32(f, current_position-start)
-        f.seek(current_position)
-
-        for triangle in self.triangles:
-            triangle.write(f)
-
-        current_position = f.tell()
-        f.seek(OFS_OFS_SHADERS)
-        # print("     offset shaders: ", current_position)
-        writeS32(f, current_position-start)
-        f.seek(current_position)
-
-        for shader in self.shaders:
-            shader.write(f)
-
-        current_position = f.tell()
-        f.seek(OFS_OFS_ST)
-        # print("     offset st: ", current_position)
-        writeS32(f, current_position-start)
-        f.seek(current_position)
-
-        for st in self.st:
-            if st is not None:
-                st.write(f)
-            else:
-                # print("SBog")
-                TexCoord([0.0, 0.0]).write(f)
-
-        current_position = f.tell()
-        f.seek(OFS_OFS_XYZ)
-        # print("     offset xyz: ", current_position)
-        writeS32(f, current_position-start)
-        f.seek(current_position)
-
-        for xyz in self.xyzs:
-            for vert in xyz:
-                if vert is not None:
-                    vert.write(f)
-                else:
-                    # print("VBog")
-                    Vertex(0, 0, 0, [0.0, 0.0, 0.0]).write(f)
-
-        current_position = f.tell()
-        f.seek(OFS_OFS_END)
-        # print("     offset end: ", current_position)
-        writeS32(f, current_position-start)
-        f.seek(current_position)
+        # no seeking, so f may also be a pipe
+        size = self.layout()
+        if self.frame_source is None:
+            buf = bytearray(size)
+            self.packInto(buf, 0)
+            f.write(buf)
+        else:
+            buf = bytearray(self.OFS_XYZNORMAL)
+            self.packHeaderInto(buf, 0)
+            f.write(buf)
+            self.writeFrames(f)
+
+
+def modelHeader(name, frames, tags, surfaces, flags=0) -> Header:
+    # lay out the whole file from the counts,
+    # tags holds num_frames * num_tags entries, frame by frame
+    num_tags = len(tags)//len(frames) if len(frames) > 0 else 0
+    ofs_frames = Header.SIZE
+    ofs_tags = ofs_frames + len(frames)*Frame.SIZE
+    ofs_surfaces = ofs_tags + len(tags)*Tag.SIZE
+    ofs_eof = ofs_surfaces + sum(sur.layout() for sur in surfaces)
+    return Header(MD3_IDENT, MD3_VERSION, name, flags, len(frames), num_tags,
+                  len(surfaces), 0, ofs_frames, ofs_tags, ofs_surfaces,
+                  ofs_eof)
+
+
+def packHead(buf, header, frames, tags):
+    # header, frames and tags, everything before the surfaces
+    header.packInto(buf, 0)
+    for i, frame in enumerate(frames):
+        frame.packInto(buf, header.OFS_FRAMES + i*Frame.SIZE)
+    for i, tag in enumerate(tags):
+        tag.packInto(buf, header.OFS_TAGS + i*Tag.SIZE)
+
+
+def packModel(name, frames, tags, surfaces, flags=0) -> bytearray:
+    # fill a single buffer with the whole file
+    header = modelHeader(name, frames, tags, surfaces, flags)
+    buf = bytearray(header.OFS_EOF)
+    packHead(buf, header, frames, tags)
+    ofs = header.OFS_SURFACES
+    for sur in surfaces:
+        if sur.frame_source is not None:
+            raise ValueError("streamed surfaces can only be written by "
+                             "writeModel")
+        sur.packInto(buf, ofs)
+        ofs += sur.OFS_END
+    return buf
+
+
+def writeModel(f, name, frames, tags, surfaces, flags=0):
+    if all(sur.frame_source is None for sur in surfaces):
+        f.write(packModel(name, frames, tags, surfaces, flags))
+        return
+    # streamed surfaces, their vertex data is written as it is produced
+    header = modelHeader(name, frames, tags, surfaces, flags)
+    buf = bytearray(header.OFS_SURFACES)
+    packHead(buf, header, frames, tags)
+    f.write(buf)
+    for sur in surfaces:
+        sur.writeWithoutOFS(f)
@@ -12,6 +12,11 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 import bpy
 from bpy.props import (
+    BoolProperty,
+    CollectionProperty,
+    EnumProperty,
+    FloatProperty,
+    IntProperty,
     StringProperty,
 )
 from bpy_extras.io_utils import (
@@ -50,6 +55,91 @@ class ImportMD3(bpy.types.Operator, ImportHelper):
         options={'HIDDEN'},
     )
 
+    files: CollectionProperty(
+        type=bpy.types.OperatorFileListElement,
+        options={'HIDDEN', 'SKIP_SAVE'},
+    )
+    directory: StringProperty(
+        subtype='DIR_PATH',
+        options={'HIDDEN', 'SKIP_SAVE'},
+    )
+
+    use_cache: BoolProperty(
+        name="Use Cache",
+        description="Reuse the parsed data of files already imported in "
+                    "this session when they did not change on disk",
+        default=True,
+    )
+
+    import_tags: BoolProperty(
+        name="Import Tags",
+        description="Create an animated empty for every tag",
+        default=True,
+    )
+
+    playback: EnumProperty(
+        name="Playback",
+        description="Animate the shape keys so that every frame plays on "
+                    "its own scene frame",
+        items=(
+            ('NONE', "None", "Do not animate the shape keys"),
+            ('CONSTANT', "Constant", "Jump from frame to frame"),
+            ('LINEAR', "Linear", "Blend between consecutive frames"),
+        ),
+        default='LINEAR',
+    )
+    clips: EnumProperty(
+        name="Clips",
+        description="Split the animation in clips from the frame names, "
+                    "like run01, run02",
+        items=(
+            ('NONE', "None", "One animation for all the frames"),
+            ('MARKERS', "Markers", "A timeline marker where each clip "
+                                   "starts"),
+            ('NLA', "NLA Strips", "One NLA strip per clip"),
+        ),
+        default='NONE',
+    )
+
+    frame_start: IntProperty(
+        name="Start Frame",
+        description="First frame to import",
+        default=0,
+        min=0,
+    )
+    frame_end: IntProperty(
+        name="End Frame",
+        description="Last frame to import, -1 for the last frame of the file",
+        default=-1,
+        min=-1,
+    )
+    frame_step: IntProperty(
+        name="Frame Step",
+        description="Import every nth frame of the range",
+        default=1,
+        min=1,
+    )
+    frame_list: StringProperty(
+        name="Frames",
+        description="Frames to import instead of the range, "
+                    "like \"0, 4, 10-20\"",
+        default="",
+    )
+
+    use_profile: BoolProperty(
+        name="Profile",
+        description="Measure the time and memory of every phase and report "
+                    "them",
+        default=False,
+    )
+    profile_path: StringProperty(
+        name="Profile Log",
+        description="JSON lines file every profiled run is appended to, "
+                    "nothing is written when empty",
+        subtype='FILE_PATH',
+        default="",
+    )
+
     def execute(self, context):
         # print("Selected: " + context.active_object.name)
         from . import import_md3
@@ -57,17 +147,37 @@ class ImportMD3(bpy.types.Operator, ImportHelper):
         keywords = self.as_keywords(
             ignore=(
                 "filter_glob",
+                "files",
+                "directory",
             ),
         )
+        # several files can be selected in the browser
+        import os
+        keywords["filepaths"] = [os.path.join(self.directory, file.name)
+                                 for file in self.files if file.name]
+        keywords["report"] = self.report
 
         if bpy.data.is_saved and context.preferences.filepaths.use_relative_paths:
-            import os
             keywords["relpath"] = os.path.dirname(bpy.data.filepath)
 
         return import_md3.main(context, **keywords)
 
     def draw(self, context):
-        pass
+        layout = self.layout
+        layout.prop(self, "use_cache")
+        layout.prop(self, "import_tags")
+        layout.prop(self, "playback")
+        layout.prop(self, "clips")
+
+        col = layout.column(heading="Frames")
+        col.prop(self, "frame_start")
+        col.prop(self, "frame_end")
+        col.prop(self, "frame_step")
+        col.prop(self, "frame_list")
+
+        col = layout.column(heading="Profile")
+        col.prop(self, "use_profile")
+        col.prop(self, "profile_path")
 
 
 class ExportMD3(bpy.types.Operator, ExportHelper):
@@ -85,6 +195,75 @@ class ExportMD3(bpy.types.Operator, ExportHelper):
 
     check_extension = True
 
+    use_streaming: BoolProperty(
+        name="Stream Frames",
+        description="Write the vertex data one frame at a time to keep "
+                    "memory low on long animations",
+        default=False,
+    )
+    use_bake: BoolProperty(
+        name="Bake Animation",
+        description="Evaluate the object on every frame of the range "
+                    "instead of exporting its shape keys, so armatures and "
+                    "modifiers are exported too",
+        default=False,
+    )
+    frame_start: IntProperty(
+        name="Start Frame",
+        description="First frame to bake, -1 for the scene start",
+        default=-1,
+        min=-1,
+    )
+    frame_end: IntProperty(
+        name="End Frame",
+        description="Last frame to bake, -1 for the scene end",
+        default=-1,
+        min=-1,
+    )
+    use_vertex_cache: BoolProperty(
+        name="Optimize Vertex Cache",
+        description="Reorder the triangles and vertices of every surface "
+                    "so the GPU vertex cache is used better, slower to "
+                    "export",
+        default=False,
+    )
+    lod_levels: IntProperty(
+        name="LOD Levels",
+        description="Decimated levels also written next to the file, as "
+                    "name_1.md3, name_2.md3",
+        default=0,
+        min=0,
+        max=2,
+    )
+    lod_ratio: FloatProperty(
+        name="LOD Ratio",
+        description="Triangles every level keeps of the level before",
+        default=0.5,
+        min=0.01,
+        max=1.0,
+        subtype='FACTOR',
+    )
+    use_incremental: BoolProperty(
+        name="Incremental",
+        description="Only rewrite the frames that changed since the last "
+                    "export to this file, when its layout is the same",
+        default=False,
+    )
+
+    use_profile: BoolProperty(
+        name="Profile",
+        description="Measure the time and memory of every phase and report "
+                    "them",
+        default=False,
+    )
+    profile_path: StringProperty(
+        name="Profile Log",
+        description="JSON lines file every profiled run is appended to, "
+                    "nothing is written when empty",
+        subtype='FILE_PATH',
+        default="",
+    )
+
     def execute(self, context):
         from . import export_md3
 
@@ -94,11 +273,32 @@ class ExportMD3(bpy.types.Operator, ExportHelper):
                 "filter_glob",
             ),
         )
+        keywords["report"] = self.report
 
         return export_md3.main(context, **keywords)
 
     def draw(self, context):
-        pass
+        layout = self.layout
+        layout.prop(self, "use_streaming")
+        layout.prop(self, "use_incremental")
+        layout.prop(self, "use_vertex_cache")
+
+        col = layout.column(heading="LOD")
+        col.prop(self, "lod_levels")
+        sub = col.column()
+        sub.active = self.lod_levels > 0
+        sub.prop(self, "lod_ratio")
+
+        col = layout.column(heading="Bake")
+        col.prop(self, "use_bake")
+        sub = col.column()
+        sub.active = self.use_bake
+        sub.prop(self, "frame_start")
+        sub.prop(self, "frame_end")
+
+        col = layout.column(heading="Profile")
+        col.prop(self, "use_profile")
+        col.prop(self, "profile_path")
 
 
 def menu_func_import(self, context):
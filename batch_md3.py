@@ -0,0 +1,240 @@
+"""Headless batch processing of MD3 files, no blender needed.
+
+    python batch_md3.py validate models/
+    python batch_md3.py reencode models/ -o out/
+    python batch_md3.py dump models/ -o out/ --json report.json
+    python batch_md3.py obj models/ -o out/ -j 8
+
+Run it from the add-on folder (or with it on PYTHONPATH).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+try:
+    from . import Utilities as ut
+    from . import lazy_md3
+except ImportError:
+    import Utilities as ut
+    import lazy_md3
+
+MODES = ('validate', 'reencode', 'dump', 'obj')
+
+
+def find_models(root) -> list[str]:
+    if os.path.isfile(root):
+        return [root]
+    paths = []
+    for folder, _, files in os.walk(root):
+        paths.extend(os.path.join(folder, name) for name in files
+                     if name.lower().endswith(".md3"))
+    return sorted(paths)
+
+
+def validate(model, size) -> list[str]:
+    errors = []
+    header = model.header
+    if header.IDENT != ut.MD3_IDENT:
+        errors.append("bad ident %d" % header.IDENT)
+    if header.VERSION != ut.MD3_VERSION:
+        errors.append("unknown version %d" % header.VERSION)
+    if header.OFS_EOF != size:
+        errors.append("ofs_eof %d but file is %d bytes"
+                      % (header.OFS_EOF, size))
+    if header.NUM_FRAMES > ut.MD3_MAX_FRAMES:
+        errors.append("%d frames" % header.NUM_FRAMES)
+    if header.NUM_TAGS > ut.MD3_MAX_TAGS:
+        errors.append("%d tags" % header.NUM_TAGS)
+    if header.NUM_SURFACES > ut.MD3_MAX_SURFACES:
+        errors.append("%d surfaces" % header.NUM_SURFACES)
+    for sur in model.surfaces:
+        if sur.OFFSET + sur.OFS_END > size:
+            errors.append("surface %s ends past the end of the file"
+                          % sur.NAME)
+            continue
+        if sur.NUM_FRAMES != header.NUM_FRAMES:
+            errors.append("surface %s has %d frames, header has %d"
+                          % (sur.NAME, sur.NUM_FRAMES, header.NUM_FRAMES))
+        triangles = sur.triangle_array
+        if len(triangles) and (triangles.min() < 0
+                               or triangles.max() >= sur.NUM_VERTS):
+            errors.append("surface %s has triangle indexes out of range"
+                          % sur.NAME)
+        if not np.isfinite(sur.st_array).all():
+            errors.append("surface %s has non finite st" % sur.NAME)
+    return errors
+
+
+def model_summary(model) -> dict:
+    return {
+        "name": model.NAME,
+        "flags": model.header.FLAGS,
+        "frames": [{"name": frame.NAME,
+                    "min_bounds": frame.MIN_BOUNDS.values(),
+                    "max_bounds": frame.MAX_BOUNDS.values(),
+                    "local_origin": frame.LOCAL_ORIGIN.values(),
+                    "radius": frame.RADIUS} for frame in model.frames],
+        "tags": [{"name": tag.NAME,
+                  "origin": tag.ORIGIN.values(),
+                  "axis": [axis.values() for axis in tag.AXIS_ROTATION]}
+                 for tag in model.tags],
+        "surfaces": [{"name": sur.NAME,
+                      "flags": sur.FLAGS,
+                      "shaders": [[sh.name, sh.shader_index]
+                                  for sh in sur.shaders],
+                      "num_frames": sur.NUM_FRAMES,
+                      "num_verts": sur.NUM_VERTS,
+                      "num_triangles": sur.NUM_TRIANGLES}
+                     for sur in model.surfaces],
+    }
+
+
+def dump(model, target):
+    # JSON summary and the raw arrays of every surface
+    os.makedirs(target, exist_ok=True)
+    with open(os.path.join(target, "summary.json"), "w") as f:
+        json.dump(model_summary(model), f, indent=1)
+    for idx, sur in enumerate(model.surfaces):
+        prefix = os.path.join(target, "surface_%d_" % idx)
+        np.save(prefix + "triangles.npy", sur.triangle_array)
+        np.save(prefix + "st.npy", sur.st_array)
+        np.save(prefix + "xyznormal.npy", sur.xyz_array)
+
+
+def write_obj(model, target):
+    # frame 0 of every surface as one OBJ group
+    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+    with open(target, "w") as f:
+        f.write("# %s\n" % model.NAME)
+        ofs = 1
+        for sur in model.surfaces:
+            if sur.NUM_FRAMES == 0:
+                continue
+            xyz = sur.frame(0)
+            st = sur.st_array.astype(np.float64)
+            f.write("g %s\n" % sur.NAME)
+            np.savetxt(f, xyz[:, :3]*ut.MD3_XYZ_SCALE, "v %.6f %.6f %.6f")
+            np.savetxt(f, np.column_stack((st[:, 0], 1.0 - st[:, 1])),
+                       "vt %.6f %.6f")
+            np.savetxt(f, ut.normals.decodeNormals(xyz[:, 3]),
+                       "vn %.6f %.6f %.6f")
+            faces = sur.triangle_array[:, [0, 2, 1]] + ofs
+            np.savetxt(f, np.repeat(faces, 3, axis=1),
+                       "f %d/%d/%d %d/%d/%d %d/%d/%d")
+            ofs += sur.NUM_VERTS
+
+
+def reencode(model, target):
+    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+    with open(target, "wb") as f:
+        ut.writeModel(f, model.NAME, model.frames, model.tags,
+                      [sur.surface() for sur in model.surfaces],
+                      model.header.FLAGS)
+
+
+def process_file(path, mode, root, output) -> dict:
+    start = time.perf_counter()
+    result = {"path": path, "ok": False, "errors": [], "bytes": 0,
+              "surfaces": 0, "vertices": 0, "frames": 0, "triangles": 0}
+    try:
+        size = os.path.getsize(path)
+        result["bytes"] = size
+        model = lazy_md3.LazyMD3(path)
+        try:
+            result["errors"] = validate(model, size)
+            result["surfaces"] = len(model.surfaces)
+            result["frames"] = len(model.frames)
+            result["vertices"] = sum(sur.NUM_VERTS for sur in model.surfaces)
+            result["triangles"] = sum(sur.NUM_TRIANGLES
+                                      for sur in model.surfaces)
+            if mode == 'validate':
+                # make sure every frame can actually be decoded
+                for sur in model.surfaces:
+                    ut.normals.decodeNormals(sur.xyz_array[..., 3])
+            elif not result["errors"]:
+                rel = os.path.relpath(path, root) \
+                    if os.path.isdir(root) else os.path.basename(path)
+                target = os.path.join(output, rel)
+                if mode == 'dump':
+                    dump(model, os.path.splitext(target)[0])
+                elif mode == 'obj':
+                    write_obj(model, os.path.splitext(target)[0] + ".obj")
+                else:
+                    reencode(model, target)
+        finally:
+            model.close()
+        result["ok"] = not result["errors"]
+    except Exception as e:
+        result["errors"].append("%s: %s" % (type(e).__name__, e))
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Validate, re-encode or convert MD3 files in bulk.")
+    parser.add_argument("mode", choices=MODES)
+    parser.add_argument("path", help="MD3 file or folder searched recursively")
+    parser.add_argument("-o", "--output", help="output folder")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="worker processes (default: all cores)")
+    parser.add_argument("--json", help="write every result to this file")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="only print failures and the summary")
+    args = parser.parse_args(argv)
+
+    if args.mode != 'validate' and args.output is None:
+        parser.error("%s needs --output" % args.mode)
+
+    paths = find_models(args.path)
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = [pool.submit(process_file, path, args.mode, args.path,
+                               args.output) for path in paths]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if not result["ok"]:
+                print("FAIL %s (%.1f ms): %s" % (
+                    result["path"], result["seconds"]*1000,
+                    "; ".join(result["errors"])))
+            elif not args.quiet:
+                print("ok   %s (%.1f ms)" % (result["path"],
+                                             result["seconds"]*1000))
+    wall = time.perf_counter() - start
+
+    failed = sum(1 for result in results if not result["ok"])
+    total_bytes = sum(result["bytes"] for result in results)
+    vertex_frames = sum(result["vertices"]*result["frames"]
+                        for result in results)
+    summary = {
+        "mode": args.mode,
+        "files": len(results),
+        "failed": failed,
+        "jobs": args.jobs,
+        "seconds": wall,
+        "files_per_second": len(results)/wall if wall > 0 else 0.0,
+        "megabytes_per_second": total_bytes/wall/1e6 if wall > 0 else 0.0,
+        "vertex_frames_per_second": vertex_frames/wall if wall > 0 else 0.0,
+    }
+    print("%d files, %d failed in %.2f s: %.1f files/s, %.1f MB/s, "
+          "%.3g vertex frames/s" % (
+              summary["files"], failed, wall, summary["files_per_second"],
+              summary["megabytes_per_second"],
+              summary["vertex_frames_per_second"]))
+
+    if args.json is not None:
+        results.sort(key=lambda result: result["path"])
+        with open(args.json, "w") as f:
+            json.dump({"summary": summary, "files": results}, f, indent=1)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
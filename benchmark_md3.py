@@ -0,0 +1,210 @@
+"""Benchmarks of the MD3 codec on synthetic models, no blender needed.
+
+    python benchmark_md3.py -o results.json
+    python benchmark_md3.py --quick -o new.json --compare results.json
+
+Every case is timed for encode (packModel + write), parse (Header, Frame,
+Tag and Surface.read from disk), lazy parse (LazyMD3 touching every frame)
+and a full round trip. Throughput is given in vertex frames per second and
+peak memory is measured with tracemalloc.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+try:
+    from . import Utilities as ut
+    from . import lazy_md3
+except ImportError:
+    import Utilities as ut
+    import lazy_md3
+
+# (frames, surfaces, vertices per surface)
+GRID = [(frames, surfaces, verts)
+        for frames in (1, 64, ut.MD3_MAX_FRAMES)
+        for surfaces in (1, 8, ut.MD3_MAX_SURFACES)
+        for verts in (500, 2000, 4000)]
+QUICK_GRID = [(1, 1, 500), (64, 8, 2000), (ut.MD3_MAX_FRAMES, 1, 2000)]
+
+
+def synthetic_model(num_frames, num_surfaces, num_verts, num_tags=2,
+                    seed=0):
+    # random but valid model: (name, frames, tags, surfaces)
+    rng = np.random.default_rng(seed)
+    frames = []
+    for idx in range(num_frames):
+        frames.append(ut.Frame(ut.Vec3(-512, -512, -512),
+                               ut.Vec3(512, 512, 512), ut.Vec3(0, 0, 0),
+                               887.0, "frame%d" % idx))
+    tags = [ut.Tag("tag_%d" % t, ut.Vec3f(0.0, 0.0, t),
+                   [ut.Vec3f(1.0, 0.0, 0.0), ut.Vec3f(0.0, 1.0, 0.0),
+                    ut.Vec3f(0.0, 0.0, 1.0)])
+            for _ in range(num_frames) for t in range(num_tags)]
+    surfaces = []
+    for idx in range(num_surfaces):
+        num_triangles = num_verts*2
+        triangles = rng.integers(0, num_verts, (num_triangles, 3),
+                                 dtype=np.int32)
+        sts = rng.random((num_verts, 2), dtype=np.float32)
+        xyzs = np.empty((num_frames, num_verts, 4), np.int16)
+        xyzs[..., :3] = rng.integers(-32768, 32768, (num_frames, num_verts, 3))
+        xyzs[..., 3] = rng.integers(0, 65536, (num_frames, num_verts)) \
+            .astype(np.uint16).view(np.int16)
+        surfaces.append(ut.Surface(ut.MD3_IDENT, "surface%d" % idx, 0,
+                                   num_frames, 1, num_verts, num_triangles,
+                                   0, 0, 0, 0, 0,
+                                   [ut.Shader("textures/surface%d.tga" % idx,
+                                              0)],
+                                   triangles, sts, xyzs))
+    return "synthetic.md3", frames, tags, surfaces
+
+
+def parse(path):
+    with open(path, "rb") as f:
+        header = ut.Header.read(f)
+        f.seek(header.OFS_FRAMES)
+        frames = [ut.Frame.read(f) for _ in range(header.NUM_FRAMES)]
+        f.seek(header.OFS_TAGS)
+        tags = [ut.Tag.read(f)
+                for _ in range(header.NUM_FRAMES*header.NUM_TAGS)]
+        surfaces = []
+        ofs = header.OFS_SURFACES
+        for _ in range(header.NUM_SURFACES):
+            f.seek(ofs)
+            surfaces.append(ut.Surface.read(f, ofs))
+            ofs += surfaces[-1].OFS_END
+    return header.NAME, frames, tags, surfaces
+
+
+def parse_lazy(path):
+    with lazy_md3.LazyMD3(path) as model:
+        checksum = 0
+        for sur in model.surfaces:
+            for frame in range(sur.NUM_FRAMES):
+                checksum += int(sur.frame(frame)[:, 3].sum())
+        return checksum
+
+
+def encode(model, path):
+    with open(path, "wb") as f:
+        ut.writeModel(f, *model)
+
+
+def round_trip(path, out):
+    with open(out, "wb") as f:
+        ut.writeModel(f, *parse(path))
+
+
+def measure(function, repeat):
+    # best wall time of repeat runs and the peak traced memory of one
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def run_case(num_frames, num_surfaces, num_verts, repeat, folder) -> dict:
+    model = synthetic_model(num_frames, num_surfaces, num_verts)
+    path = os.path.join(folder, "case.md3")
+    out = os.path.join(folder, "round_trip.md3")
+    vertex_frames = num_frames*num_surfaces*num_verts
+
+    result = {"frames": num_frames, "surfaces": num_surfaces,
+              "verts": num_verts, "vertex_frames": vertex_frames}
+    for name, function in (("encode", lambda: encode(model, path)),
+                           ("parse", lambda: parse(path)),
+                           ("parse_lazy", lambda: parse_lazy(path)),
+                           ("round_trip", lambda: round_trip(path, out))):
+        seconds, peak = measure(function, repeat)
+        result[name] = {"seconds": seconds, "peak_bytes": peak,
+                        "vertex_frames_per_second":
+                            vertex_frames/seconds if seconds > 0 else 0.0}
+    result["bytes"] = os.path.getsize(path)
+    with open(path, "rb") as a, open(out, "rb") as b:
+        result["round_trip_identical"] = a.read() == b.read()
+    return result
+
+
+def compare(results, baseline, threshold) -> list[str]:
+    # slower cases than in the baseline file, by more than threshold
+    old = {(r["frames"], r["surfaces"], r["verts"]): r
+           for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        key = (result["frames"], result["surfaces"], result["verts"])
+        if key not in old:
+            continue
+        for name in ("encode", "parse", "parse_lazy", "round_trip"):
+            if name not in old[key]:
+                continue
+            ratio = result[name]["seconds"]/old[key][name]["seconds"]
+            if ratio > 1.0 + threshold:
+                regressions.append("%s %s: %.2fx slower" % (key, name, ratio))
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the MD3 codec on synthetic models.")
+    parser.add_argument("-o", "--output", default="benchmark_md3.json",
+                        help="JSON file receiving the results")
+    parser.add_argument("--quick", action="store_true",
+                        help="only run a few small cases")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-vertex-frames", type=int, default=32*10**6,
+                        help="skip the grid cases larger than this")
+    parser.add_argument("--compare", help="previous results to compare to")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="slowdown reported as a regression")
+    args = parser.parse_args(argv)
+
+    grid = QUICK_GRID if args.quick else GRID
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for num_frames, num_surfaces, num_verts in grid:
+            if num_frames*num_surfaces*num_verts > args.max_vertex_frames:
+                continue
+            result = run_case(num_frames, num_surfaces, num_verts,
+                              args.repeat, folder)
+            results.append(result)
+            print("%5d frames %3d surfaces %5d verts: " % (
+                num_frames, num_surfaces, num_verts) + ", ".join(
+                "%s %.2f ms (%.3g vf/s)" % (
+                    name, result[name]["seconds"]*1000,
+                    result[name]["vertex_frames_per_second"])
+                for name in ("encode", "parse", "parse_lazy", "round_trip")))
+
+    report = {
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""Benchmark of the vertex cache optimisation on synthetic grids.
+
+    python benchmark_vertex_cache.py -o vertex_cache.json
+    python benchmark_vertex_cache.py --quick
+
+Every grid of quads is split in two triangles per quad and given to
+vertex_cache.optimizeSurface once in row order and once shuffled, like the
+polygon order of an edited mesh. The ACMR (transformed vertices per
+triangle) of a FIFO cache is reported before and after, with the time the
+reordering took.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+
+try:
+    from . import Utilities as ut
+    from . import vertex_cache
+except ImportError:
+    import Utilities as ut
+    import vertex_cache
+
+# quads per side, 63 is the largest grid within the 4096 vertices engines
+# allow per surface and 128 shows how the time grows past it
+GRID = [8, 16, 32, 63, 128]
+QUICK_GRID = [16, 63]
+ORDERS = ("rows", "shuffled")
+
+
+def grid_surface(size, num_frames, order="rows", seed=0) -> ut.Surface:
+    # flat size x size quads, the frames move it up step by step
+    xs, ys = np.meshgrid(np.arange(size + 1), np.arange(size + 1))
+    corner = (ys*(size + 1) + xs)[:-1, :-1].ravel()
+    right, up = corner + 1, corner + size + 1
+    triangles = np.concatenate([
+        np.stack([corner, right, up + 1], -1),
+        np.stack([corner, up + 1, up], -1)], 1).reshape(-1, 3)
+    if order == "shuffled":
+        rng = np.random.default_rng(seed)
+        triangles = triangles[rng.permutation(len(triangles))]
+    num_verts = (size + 1)**2
+    sts = np.stack([xs.ravel(), ys.ravel()], -1).astype(np.float32)/size
+    xyzs = np.zeros((num_frames, num_verts, 4), np.int16)
+    xyzs[..., 0] = xs.ravel()*64
+    xyzs[..., 1] = ys.ravel()*64
+    xyzs[..., 2] = np.arange(num_frames)[:, None]
+    return ut.Surface(ut.MD3_IDENT, "grid", 0, num_frames, 0, num_verts,
+                      len(triangles), 0, 0, 0, 0, 0, [], triangles, sts, xyzs)
+
+
+def run_case(size, order, num_frames, cache_size, repeat) -> dict:
+    best = float('inf')
+    for _ in range(repeat):
+        sur = grid_surface(size, num_frames, order)
+        before = vertex_cache.acmr(sur.triangle_array, cache_size)
+        start = time.perf_counter()
+        vertex_cache.optimizeSurface(sur, cache_size)
+        best = min(best, time.perf_counter() - start)
+    return {"size": size, "order": order, "frames": num_frames,
+            "triangles": len(sur.triangle_array),
+            "verts": len(sur.st_array), "seconds": best,
+            "acmr_before": before,
+            "acmr_after": vertex_cache.acmr(sur.triangle_array, cache_size)}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the vertex cache optimisation on grids.")
+    parser.add_argument("-o", "--output", default="benchmark_vertex_cache.json",
+                        help="JSON file receiving the results")
+    parser.add_argument("--quick", action="store_true",
+                        help="only run a few small grids")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--frames", type=int, default=64,
+                        help="frames of xyznormal permuted with the vertices")
+    parser.add_argument("--cache-size", type=int,
+                        default=vertex_cache.CACHE_SIZE)
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in QUICK_GRID if args.quick else GRID:
+        for order in ORDERS:
+            result = run_case(size, order, args.frames, args.cache_size,
+                              args.repeat)
+            results.append(result)
+            print("%4dx%-4d %-8s %6d triangles: ACMR %.3f -> %.3f in %.2f ms"
+                  % (size, size, order, result["triangles"],
+                     result["acmr_before"], result["acmr_after"],
+                     result["seconds"]*1000))
+
+    report = {
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "cache_size": args.cache_size,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+import os
+import threading
+from collections import OrderedDict
+
+try:
+    from . import model_md3
+except ImportError:
+    import model_md3
+
+if "model_md3" in locals():
+    import importlib
+    importlib.reload(model_md3)
+
+DEFAULT_BUDGET: int = 256*1024*1024
+
+
+def cacheKey(filepath) -> tuple:
+    # a file rewritten on disk gets a new key, the old entry just ages out
+    path = os.path.realpath(filepath)
+    st = os.stat(path)
+    return path, st.st_size, st.st_mtime_ns
+
+
+class ModelCache:
+    # parsed MD3Model of recently imported files, least recently used first,
+    # the models are shared and must not be modified by the callers
+    def __init__(self, budget=DEFAULT_BUDGET) -> None:
+        self.budget: int = budget
+        self.entries: OrderedDict = OrderedDict()
+        self.nbytes: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.lock = threading.Lock()
+
+    def get(self, filepath) -> model_md3.MD3Model:
+        key = cacheKey(filepath)
+        with self.lock:
+            model = self.entries.get(key)
+            if model is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return model
+            self.misses += 1
+
+        # parsed outside of the lock so different files load in parallel
+        model = model_md3.MD3Model.read(key[0])
+        with self.lock:
+            if key not in self.entries and model.nbytes <= self.budget:
+                self.entries[key] = model
+                self.nbytes += model.nbytes
+                self.evict()
+        return model
+
+    def evict(self):
+        while self.nbytes > self.budget and self.entries:
+            _, model = self.entries.popitem(last=False)
+            self.nbytes -= model.nbytes
+            self.evictions += 1
+
+    def setBudget(self, budget):
+        with self.lock:
+            self.budget = budget
+            self.evict()
+
+    def invalidate(self, filepath=None):
+        # forget every version of one file, or everything
+        with self.lock:
+            if filepath is None:
+                keys = list(self.entries)
+            else:
+                path = os.path.realpath(filepath)
+                keys = [key for key in self.entries if key[0] == path]
+            for key in keys:
+                self.nbytes -= self.entries.pop(key).nbytes
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.nbytes,
+                    "budget": self.budget, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+
+# shared by every import of the session
+CACHE = ModelCache()
+
+
+def load(filepath) -> model_md3.MD3Model:
+    return CACHE.get(filepath)
+
+
+def invalidate(filepath=None):
+    CACHE.invalidate(filepath)
+
+
+def stats() -> dict:
+    return CACHE.stats()
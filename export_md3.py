@@ -1,34 +1,426 @@
-import math
+import hashlib
+import json
+import os
 import bpy
-from numpy import amin, amax
+import numpy as np
 from . import Utilities as ut
+from . import profile_md3
+from . import vertex_cache
 
 if "ut" in locals():
     import importlib
     importlib.reload(ut)
-
-
-def bounding_box(data):
-    new_arrangement = [[key.co.x, key.co.y, key.co.z] for key in data]
-    min = amin(new_arrangement, axis=0)
-    max = amax(new_arrangement, axis=0)
-    return min, max
-
-    # return [(min, min, min), (min, min, max), (min, max, min),
-    #         (min, max, max), (max, min, min), (max, min, max),
-    #         (max, max, min), (max, max, max)]
-    # rien à voir avec cette fonction
-
-
-def export(obj, filepath):
+    importlib.reload(profile_md3)
+    importlib.reload(vertex_cache)
+
+# hashes of the last export, stored next to the md3 file
+SIDECAR_SUFFIX: str = ".hashes.json"
+SIDECAR_VERSION: int = 2
+# uvs closer than this are the same st, a 65536 pixel texture's texel
+UV_PRECISION: float = 65536.0
+
+
+def gather_shape_keys(key_blocks, num_verts) -> np.ndarray:
+    # (num_frames, num_verts, 3) positions of every key block
+    cos = np.empty((len(key_blocks), num_verts, 3), np.float32)
+    for idx, shape in enumerate(key_blocks):
+        shape.data.foreach_get('co', cos[idx].reshape(-1))
+    return cos
+
+
+def iter_shape_keys(key_blocks, num_verts):
+    # the positions of one key block at a time, in a reused buffer
+    co = np.empty((num_verts, 3), np.float32)
+    for shape in key_blocks:
+        shape.data.foreach_get('co', co.reshape(-1))
+        yield co
+
+
+def frame_bounds(cos):
+    # bounds, center and radius of every frame at once
+    if cos.shape[1] == 0:
+        zeros = np.zeros((len(cos), 3))
+        return zeros, zeros, zeros, np.zeros(len(cos))
+    minim = cos.min(axis=1).astype(np.float64)
+    maxim = cos.max(axis=1).astype(np.float64)
+    center = (minim + maxim) / 2.0
+    radius = np.linalg.norm(maxim - minim, axis=1)/2.0
+    return minim, maxim, center, radius
+
+
+def quantize(cos):
+    # positions -> int16 MD3 units, return them and the number of vertices
+    # that did not fit and were clipped
+    q = np.trunc(cos / ut.MD3_XYZ_SCALE)
+    limits = np.iinfo(np.int16)
+    outside = ((q < limits.min) | (q > limits.max)).any(axis=-1)
+    np.clip(q, limits.min, limits.max, out=q)
+    return q.astype(np.int16), int(np.count_nonzero(outside))
+
+
+def vertex_normals(cos, triangles) -> np.ndarray:
+    # smooth normals of every frame, (frames, verts, 3) like cos: the face
+    # normals, weighted by area, summed on their vertices then normalized
+    num_frames, num_verts = cos.shape[:2]
+    normals = np.empty((num_frames, num_verts, 3), np.float32)
+    # frames are done in chunks to bound the temporary arrays
+    step = max(1, 2**20 // max(len(triangles), 1))
+    for start in range(0, num_frames, step):
+        chunk = cos[start:start + step]
+        corners = [chunk[:, triangles[:, k]] for k in range(3)]
+        faces = np.cross(corners[1] - corners[0], corners[2] - corners[0])
+        # one bincount per axis sums the faces of every vertex of every
+        # frame of the chunk at once
+        count = len(chunk)*num_verts
+        index = (np.arange(len(chunk))[:, None]*num_verts)[None] \
+            + triangles.T[:, None, :]
+        for axis in range(3):
+            weights = np.broadcast_to(faces[..., axis], index.shape)
+            sums = np.bincount(index.ravel(), weights.ravel(), count)
+            normals[start:start + step, :, axis] = \
+                sums.reshape(len(chunk), num_verts)
+    length = np.linalg.norm(normals, axis=-1, keepdims=True)
+    # vertices without faces keep a null normal, encoded as +z
+    np.divide(normals, length, out=normals, where=length > 0)
+    return normals
+
+
+def encode_frame(co, remap, normals):
+    # one frame of one surface -> (num_verts, 4) int16 block, clipped count
+    positions, clipped = quantize(co[remap])
+    return ut.packVertices(positions, normals), clipped
+
+
+def stream_frames(key_blocks, num_verts, remap, triangles, clipped):
+    # packed vertices of one surface, one frame at a time, the normals of
+    # each frame are computed from the mesh triangles around its vertices,
+    # picked once so every surface doesn't go over the whole mesh per frame
+    touching = np.zeros(num_verts, bool)
+    touching[remap] = True
+    triangles = triangles[touching[triangles].any(1)]
+
+    def source():
+        for co in iter_shape_keys(key_blocks, num_verts):
+            normals = vertex_normals(co[None], triangles)[0]
+            block, frame_clipped = encode_frame(co, remap, normals[remap])
+            clipped[0] += frame_clipped
+            yield block
+    return source
+
+
+def encoded_frames(cos, nors, remap, clipped):
+    # like stream_frames from the gathered positions and normals,
+    # clipped[i] receives the clipped count of frame i
+    def source():
+        for idx, co in enumerate(cos):
+            block, clipped[idx] = encode_frame(co, remap, nors[idx][remap])
+            yield block
+    return source
+
+
+def frame_hashes(cos, nors, remaps) -> list[list[str]]:
+    # content hash of the positions and normals of every frame of every
+    # surface
+    hashes = []
+    for co, nor in zip(cos, nors):
+        row = []
+        for remap in remaps:
+            digest = hashlib.blake2b(co[remap], digest_size=16)
+            digest.update(nor[remap])
+            row.append(digest.hexdigest())
+        hashes.append(row)
+    return hashes
+
+
+def layout_hash(header, tags, surfaces) -> str:
+    # hash of everything that is not patched in place: counts, offsets,
+    # tags, triangles, shaders and st of every surface
+    digest = hashlib.blake2b(header.pack(), digest_size=16)
+    for tag in tags:
+        digest.update(tag.pack())
+    for sur in surfaces:
+        buf = bytearray(sur.OFS_XYZNORMAL)
+        sur.packHeaderInto(buf, 0)
+        digest.update(buf)
+    return digest.hexdigest()
+
+
+def read_sidecar(filepath, header, layout):
+    # the hashes of the last export, None when the file can not be patched
+    try:
+        with open(filepath + SIDECAR_SUFFIX) as f:
+            old = json.load(f)
+        st = os.stat(filepath)
+    except (OSError, ValueError):
+        return None
+    if (old.get("version") != SIDECAR_VERSION
+            or old.get("layout") != layout
+            or old.get("size") != st.st_size
+            or old.get("mtime_ns") != st.st_mtime_ns
+            or st.st_size != header.OFS_EOF):
+        return None
+    return old
+
+
+def write_sidecar(filepath, layout, hashes, frame_clipped):
+    st = os.stat(filepath)
+    with open(filepath + SIDECAR_SUFFIX, "w") as f:
+        json.dump({"version": SIDECAR_VERSION, "size": st.st_size,
+                   "mtime_ns": st.st_mtime_ns, "layout": layout,
+                   "hashes": hashes, "clipped": frame_clipped.tolist()}, f)
+
+
+def write_incremental(filepath, name, frames, tags, surfaces, flags, cos,
+                      nors, remaps, frame_clipped) -> int:
+    # overwrite in place the frames that changed since the last export, or
+    # write the whole file when its layout is different, return the number
+    # of clipped vertices
+    header = ut.modelHeader(name, frames, tags, surfaces, flags)
+    layout = layout_hash(header, tags, surfaces)
+    hashes = frame_hashes(cos, nors, remaps)
+    old = read_sidecar(filepath, header, layout)
+    if old is None:
+        with open(filepath, "wb") as exportFile:
+            ut.writeModel(exportFile, name, frames, tags, surfaces, flags)
+        print("No matching previous export, the whole file was written")
+    else:
+        frame_clipped[:] = old["clipped"]
+        patched = 0
+        with open(filepath, "r+b") as exportFile:
+            # the bounds of a frame follow its vertices
+            exportFile.seek(header.OFS_FRAMES)
+            data = exportFile.read(len(frames)*ut.Frame.SIZE)
+            for idx, frame in enumerate(frames):
+                record = frame.pack()
+                ofs = idx*ut.Frame.SIZE
+                if data[ofs:ofs + ut.Frame.SIZE] != record:
+                    exportFile.seek(header.OFS_FRAMES + ofs)
+                    exportFile.write(record)
+            ofs_surface = header.OFS_SURFACES
+            for num, (sur, remap) in enumerate(zip(surfaces, remaps)):
+                for idx in range(len(frames)):
+                    if hashes[idx][num] == old["hashes"][idx][num]:
+                        continue
+                    block, frame_clipped[idx, num] = encode_frame(
+                        cos[idx], remap, nors[idx][remap])
+                    exportFile.seek(ofs_surface + sur.OFS_XYZNORMAL
+                                    + idx*block.nbytes)
+                    exportFile.write(block.tobytes())
+                    patched += 1
+                ofs_surface += sur.OFS_END
+        print("Patched", patched, "of", len(frames)*len(surfaces),
+              "surface frames")
+    write_sidecar(filepath, layout, hashes, frame_clipped)
+    return int(frame_clipped.sum())
+
+
+def bake_frames(obj, frame_start, frame_end):
+    # evaluate obj on every frame of the range through the depsgraph,
+    # return the (frames, verts, 3) positions and normals and a copy of the
+    # first evaluated mesh for the topology, uvs and materials
+    num_frames = frame_end - frame_start + 1
+    if num_frames < 1:
+        raise ValueError("the bake range %d-%d is empty"
+                         % (frame_start, frame_end))
+    if num_frames > ut.MD3_MAX_FRAMES:
+        raise ValueError("the bake range %d-%d has more than %d frames"
+                         % (frame_start, frame_end, ut.MD3_MAX_FRAMES))
+    scene = bpy.context.scene
+    current = scene.frame_current
+    mesh = None
+    try:
+        for idx, frame in enumerate(range(frame_start, frame_end + 1)):
+            scene.frame_set(frame)
+            depsgraph = bpy.context.evaluated_depsgraph_get()
+            obj_eval = obj.evaluated_get(depsgraph)
+            evaluated = obj_eval.to_mesh()
+            try:
+                if mesh is None:
+                    mesh = bpy.data.meshes.new_from_object(
+                        obj_eval, preserve_all_data_layers=True,
+                        depsgraph=depsgraph)
+                    shape = (len(evaluated.vertices), len(evaluated.loops),
+                             len(evaluated.polygons))
+                    loops = np.empty(shape[1], np.int32)
+                    evaluated.loops.foreach_get('vertex_index', loops)
+                    loop_check = np.empty_like(loops)
+                    cos = np.empty((num_frames, shape[0], 3), np.float32)
+                    nors = np.empty_like(cos)
+                else:
+                    # the buffers only fit a mesh with the same topology
+                    same = shape == (len(evaluated.vertices),
+                                     len(evaluated.loops),
+                                     len(evaluated.polygons))
+                    if same:
+                        evaluated.loops.foreach_get('vertex_index',
+                                                    loop_check)
+                        same = np.array_equal(loops, loop_check)
+                    if not same:
+                        raise ValueError("the topology of %s changes on "
+                                         "frame %d" % (obj.name, frame))
+                evaluated.vertices.foreach_get('co', cos[idx].reshape(-1))
+                evaluated.vertices.foreach_get('normal',
+                                               nors[idx].reshape(-1))
+            finally:
+                obj_eval.to_mesh_clear()
+    except Exception:
+        if mesh is not None:
+            bpy.data.meshes.remove(mesh)
+        raise
+    finally:
+        scene.frame_set(current)
+    return cos, nors, mesh
+
+
+def loop_triangles(mesh) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # material index, vertices and loops of every triangle of the mesh
+    # quads and n-gons are read through the loop triangles of the mesh,
+    # nothing has to be triangulated beforehand
+    mesh.calc_loop_triangles()
+    num_triangles = len(mesh.loop_triangles)
+    material_index = np.empty(num_triangles, np.int32)
+    mesh.loop_triangles.foreach_get('material_index', material_index)
+    tri_loops = np.empty((num_triangles, 3), np.int32)
+    mesh.loop_triangles.foreach_get('loops', tri_loops.ravel())
+    tri_verts = np.empty((num_triangles, 3), np.int32)
+    mesh.loop_triangles.foreach_get('vertices', tri_verts.ravel())
+    return material_index, tri_verts, tri_loops
+
+
+def material_split(material_index, tri_verts, corner_uvs, num_materials):
+    # split the triangles by material, for each one return the mesh vertex
+    # of every surface vertex (the remap from surface to mesh vertices), its
+    # triangles in surface vertices and the st of every surface vertex
+    # a surface vertex is a (mesh vertex, uv) pair, a mesh vertex on a uv
+    # seam becomes one surface vertex per side of the seam
+
+    # sort the triangles by material once, each split is then a slice
+    order = np.argsort(material_index, kind='stable')
+    bounds = np.searchsorted(material_index[order],
+                             np.arange(num_materials + 1))
+    splits = []
+    for num_mat in range(num_materials):
+        triangles = order[bounds[num_mat]:bounds[num_mat + 1]]
+        uvs = corner_uvs[triangles].reshape(-1, 2)
+        keys = np.empty((len(uvs), 3), np.int64)
+        keys[:, 0] = tri_verts[triangles].ravel()
+        keys[:, 1:] = np.round(uvs*UV_PRECISION)
+        # sorted by mesh vertex first, without seams the surface vertices
+        # are the mesh vertices in the same order as before
+        unique, local = np.unique(keys, axis=0, return_inverse=True)
+        local = local.reshape(-1)
+        sts = np.empty((len(unique), 2), np.float32)
+        sts[local] = uvs
+        splits.append((unique[:, 0], local.reshape(-1, 3), sts))
+    return splits
+
+
+def cluster_count(co, cell, triangles) -> tuple[np.ndarray, int]:
+    # cluster of every vertex on a grid of cell sized cubes and the number
+    # of triangles left with three different clusters
+    cells = np.floor((co - co.min(0))/cell).astype(np.int64)
+    side = int(cells.max()) + 1
+    _, cluster = np.unique((cells[:, 0]*side + cells[:, 1])*side
+                           + cells[:, 2], return_inverse=True)
+    cluster = cluster.reshape(-1)
+    corners = cluster[triangles]
+    left = np.count_nonzero((corners[:, 0] != corners[:, 1])
+                            & (corners[:, 1] != corners[:, 2])
+                            & (corners[:, 2] != corners[:, 0]))
+    return cluster, left
+
+
+def decimate(co, triangles, target) -> np.ndarray:
+    # vertex clustering down to at most target triangles, returns the
+    # vertex every mesh vertex collapses to, a used vertex of its cluster
+    # closest to the cluster center, so the frames just keep moving it
+    num_verts = len(co)
+    collapse = np.arange(num_verts)
+    used = np.zeros(num_verts, bool)
+    used[triangles.ravel()] = True
+    if len(triangles) <= target or not used.any():
+        return collapse
+    co = co[used]
+    extent = float((co.max(0) - co.min(0)).max())
+    if extent == 0.0:
+        return collapse
+
+    # the triangles left shrink as the cells grow, the cell size is
+    # bisected down to the smallest one leaving no more than target
+    used_index = np.flatnonzero(used)
+    local = np.searchsorted(used_index, triangles)
+    low, high = extent/4096.0, 2.0*extent
+    cluster, _ = cluster_count(co, high, local)
+    for _ in range(24):
+        cell = (low*high)**0.5
+        cells, left = cluster_count(co, cell, local)
+        if left <= target:
+            high, cluster = cell, cells
+        else:
+            low = cell
+        if high/low < 1.01:
+            break
+
+    num_clusters = int(cluster.max()) + 1
+    size = np.bincount(cluster, minlength=num_clusters)
+    center = np.stack([np.bincount(cluster, co[:, axis], num_clusters)
+                       for axis in range(3)], -1)/size[:, None]
+    distance = ((co - center[cluster])**2).sum(1)
+    # first vertex of every cluster once sorted by distance to its center
+    order = np.lexsort((distance, cluster))
+    first = order[np.searchsorted(cluster[order], np.arange(num_clusters))]
+    collapse[used] = used_index[first[cluster]]
+    return collapse
+
+
+def lod_filepath(filepath, level) -> str:
+    # model.md3 -> model_1.md3, the name the engines look the levels up by
+    root, ext = os.path.splitext(filepath)
+    return "%s_%d%s" % (root, level, ext)
+
+
+def lod_splits(co, material_index, tri_verts, tri_loops, uvs, num_materials,
+               target) -> list:
+    # material splits of the mesh decimated to about target triangles,
+    # mapped on the mesh vertices like the full detail splits
+    collapse = decimate(co, tri_verts, target)
+    lod_verts = collapse[tri_verts]
+    keep = ((lod_verts[:, 0] != lod_verts[:, 1])
+            & (lod_verts[:, 1] != lod_verts[:, 2])
+            & (lod_verts[:, 2] != lod_verts[:, 0]))
+    # a collapsed corner takes the uv of a corner of its new vertex
+    corner_loop = np.zeros(len(co), np.int64)
+    corner_loop[tri_verts.ravel()[::-1]] = tri_loops.ravel()[::-1]
+    loops = np.where(lod_verts == tri_verts, tri_loops,
+                     corner_loop[lod_verts])
+    return material_split(material_index[keep], lod_verts[keep],
+                          uvs[loops[keep]], num_materials)
+
+
+def optimize_splits(splits) -> tuple[list, int, int]:
+    # reorder the triangles of every split for the vertex cache and number
+    # the vertices in first use order, returns the new splits and the cache
+    # misses of the written triangles before and after
+    optimized = []
+    misses_before = misses_after = 0
+    for remap, local, sts in splits:
+        # measured in the file winding, the order they are drawn in
+        misses_before += vertex_cache.cacheMisses(local[:, [0, 2, 1]])
+        vertex_order, local = vertex_cache.optimizeTriangles(local,
+                                                             len(remap))
+        misses_after += vertex_cache.cacheMisses(local[:, [0, 2, 1]])
+        optimized.append((remap[vertex_order], local, sts[vertex_order]))
+    return optimized, misses_before, misses_after
+
+
+def export(obj, filepath, streaming=False, incremental=False,
+           profiler=None, bake_range=None, optimize_cache=False, stats=None,
+           lod_levels=0, lod_ratio=0.5):
+    profiler = profiler or profile_md3.Profiler()
+    stats = {} if stats is None else stats
     Frames = []
     Tags = []
-    current_position = 0
-    IDENT = 860898377
-
-    VERSION = 15
-    exportFile = open(filepath,
-                      "w+b")
+    Surfaces = []
 
     print("MD3 export")
     print("Started exporting : ", obj.name)
@@ -36,200 +428,273 @@ def export(obj, filepath):
     #print("Exporting simple values ...")
     #print()
 
-    ut.writeS32(exportFile, IDENT)
-    ut.writeS32(exportFile, VERSION)
     # use object name as file name
-    ut.writemax(exportFile, (obj.name.rsplit('.', 1)[0]+".md3")
-                .encode("utf-8"), ut.MAX_QPATH)
-
+    NAME = obj.name.rsplit('.', 1)[0]+".md3"
     FLAGS = 0  # DONT KNOW HOW TO IMPLEMENT THIS YET
     # AND DON'T KNOW HOW IT IS USED
-    ut.writeS32(exportFile, FLAGS)
-    NUM_FRAMES = len(obj.data.shape_keys.key_blocks)
-    ut.writeS32(exportFile, NUM_FRAMES)
-    NUM_TAGS = 0  # LIKE FOR FLAGS, DONT KNOW HOW TO IMPLEMENT THIS YET
-    ut.writeS32(exportFile, NUM_TAGS)
-    NUM_SURFACES = len(obj.data.materials)
-    ut.writeS32(exportFile, NUM_SURFACES)
-    NUM_SKINS = 0  # DOCUMENTATION SAYS THIS IS NOT USED
-    ut.writeS32(exportFile, NUM_SKINS)
-    OFS_OFS_FRAMES = exportFile.tell()  # REMEMBER THE POSITION FOR FUTURE EDIT
-    OFS_FRAMES = 0  # THIS IS A PLACEHOLDER
-    ut.writeS32(exportFile, OFS_FRAMES)
-    OFS_OFS_TAGS = exportFile.tell()  # REMEMBER THE POSITION FOR FUTURE EDIT
-    OFS_TAGS = 0  # THIS IS A PLACEHOLDER
-    ut.writeS32(exportFile, OFS_TAGS)
-    OFS_OFS_SURFACES = exportFile.tell()  # REMEMBER THE POSITION FOR FUTURE
-    OFS_SURFACES = 0  # THIS IS A PLACEHOLDER
-    ut.writeS32(exportFile, OFS_SURFACES)
-    OFS_OFS_EOF = exportFile.tell()  # REMEMBER THE POSITION FOR FUTURE EDIT
-    OFS_EOF = 0  # THIS IS A PLACEHOLDER
-    ut.writeS32(exportFile, OFS_EOF)
-
-    # go replace the placeholder with the real value
-
-    current_position = exportFile.tell()
-    exportFile.seek(OFS_OFS_FRAMES)
-    # print("OFS_FRAMES : ", current_position)
-    ut.writeS32(exportFile, current_position)
-    exportFile.seek(current_position)
-
-    # print()
-    # print("Exporting complex values")
-    # print()
 
     # create the frames for writting
 
-    for shape in obj.data.shape_keys.key_blocks:
-        minim, maxim = bounding_box(shape.data)
-        # print(minim, maxim)
-        center = (minim + maxim) / 2.0
-        radius = math.dist(minim, maxim)/2.0
-
-        minim = [int(math.floor(a/ut.MD3_XYZ_SCALE)) for a in minim]
-        maxim = [int(math.floor(a/ut.MD3_XYZ_SCALE)) for a in maxim]
-        center = [int(math.floor(a/ut.MD3_XYZ_SCALE)) for a in center]
-        # print(minim, maxim, center)
-        min_bound = ut.Vec3(*minim)
-        max_bound = ut.Vec3(*maxim)
-        local_origin = ut.Vec3(*center)
-
-        Frames.append(ut.Frame(min_bound, max_bound,
-                               local_origin, radius, shape.name))
-
-    for f in Frames:
-        f.write(exportFile)
-
-    # go replace the placeholder with the real value
-
-    current_position = exportFile.tell()
-    exportFile.seek(OFS_OFS_TAGS)
-    # print("OFS_TAGS : ", current_position)
-    ut.writeS32(exportFile, current_position)
-    exportFile.seek(current_position)
-
-    for t in Tags:  # like flags, dont know how to implement this yet
-        t.write(exportFile)
-
-    current_position = exportFile.tell()
-    exportFile.seek(OFS_OFS_SURFACES)
-    # print("OFS_SURFACES", current_position)
-    ut.writeS32(exportFile, current_position)
-    exportFile.seek(current_position)
-
-    # write all surface into exportFile
-
-    # Create an empty list named indexes and add an empty list for every
-    # object material
-    # then Loop through all polygons of obj, store each
-    # vertices index in the list
-    # corresponding to the polygon material_index
-
-    indexes = []
-    for i in range(len(obj.data.materials)):
-        indexes.append([])
-    for poly in obj.data.polygons:
-        indexes[poly.material_index].extend(poly.vertices)
-
-    # make sure every list dosen't contain duplicates and sort it
-    for i in range(len(indexes)):
-        indexes[i] = list(dict.fromkeys(indexes[i]))
-        indexes[i].sort()
-    num_mat = 0
-
-    mat: bpy.types.Material
-
-    uv = obj.data.uv_layers.active
-
-    for id, mat in enumerate(obj.data.materials):
-        # store number of node in num_shaders
-
-        num_frames = len(obj.data.shape_keys.key_blocks)
-        num_shaders = len(mat.node_tree.nodes)-2
-        num_verts = len(indexes[num_mat])
-
-        mat_triangles = [(idx, tri.vertices)
-                         for idx, tri in enumerate(obj.data.polygons)
-                         if tri.material_index == num_mat]
-        sur_triangles = [ut.Triangle([indexes[num_mat].index(vtx)
-                                      for vtx in tri])
-                         for _, tri in mat_triangles]
-        num_triangles = len(mat_triangles)
-
-        shaders: list[ut.Shader] = []
-
-        if num_shaders > 0:
-            if mat.node_tree.nodes.get("Image Texture") is not None:
-                node = mat.node_tree.nodes.get("Image Texture")
-                #if node.image.filepath start with "//" then use string after "//" as path
-                if node.image.filepath.startswith("//"):
-                    path = node.image.filepath[2:]
-                else: 
-                    path = node.image.filepath.rsplit("\\", 1)[1]
+    mesh = obj.data
+    # the copy of the evaluated mesh when baking, removed at the end
+    baked_mesh = None
+    if incremental or bake_range is not None:
+        # every frame is hashed or baked, so the positions are gathered
+        # anyway
+        streaming = False
+    try:
+        with profiler.phase("gather"):
+            if bake_range is not None:
+                # no shape keys, the evaluated mesh of every frame goes
+                # straight into the buffers, its first frame gives the
+                # topology
+                cos, nors, mesh = bake_frames(obj, *bake_range)
+                baked_mesh = mesh
+                frame_names = ["frame%d" % frame for frame in
+                               range(bake_range[0], bake_range[1] + 1)]
+            else:
+                key_blocks = mesh.shape_keys.key_blocks
+                frame_names = [shape.name for shape in key_blocks]
+            if streaming:
+                # only one frame of the mesh is held at a time, the surfaces
+                # read the key blocks again while they are written
+                cos = None
+                bounds = [frame_bounds(co[None]) for co in
+                          iter_shape_keys(key_blocks, len(mesh.vertices))]
+                minim, maxim, center, radius = (np.concatenate(values)
+                                                for values in zip(*bounds))
+            else:
+                if bake_range is None:
+                    cos = gather_shape_keys(key_blocks, len(mesh.vertices))
+                minim, maxim, center, radius = frame_bounds(cos)
+        minim = np.floor(minim/ut.MD3_XYZ_SCALE).astype(int).tolist()
+        maxim = np.floor(maxim/ut.MD3_XYZ_SCALE).astype(int).tolist()
+        center = np.floor(center/ut.MD3_XYZ_SCALE).astype(int).tolist()
+
+        for idx, frame_name in enumerate(frame_names):
+            Frames.append(ut.Frame(ut.Vec3(*minim[idx]), ut.Vec3(*maxim[idx]),
+                                   ut.Vec3(*center[idx]), float(radius[idx]),
+                                   frame_name))
+
+        # write all surface into exportFile
+
+        # split the mesh by material, the remap of each surface is reused for
+        # every frame
+
+        uv = mesh.uv_layers.active
+        uvs = np.zeros((len(mesh.loops), 2), np.float32)
+        if uv is not None:
+            uv.data.foreach_get('uv', uvs.ravel())
+
+        with profiler.phase("remap"):
+            material_index, tri_verts, tri_loops = loop_triangles(mesh)
+            num_materials = len(mesh.materials)
+            levels = [(filepath,
+                       material_split(material_index, tri_verts,
+                                      uvs[tri_loops], num_materials))]
+            if lod_levels > 0:
+                # every level is decimated from the full detail on the first
+                # frame, its surfaces are mapped on the mesh vertices too so
+                # all frames are carried through the same way
+                if cos is not None:
+                    base = cos[0]
+                else:
+                    base = gather_shape_keys(key_blocks[:1],
+                                             len(mesh.vertices))[0]
+                for level in range(1, lod_levels + 1):
+                    target = int(len(tri_verts)*lod_ratio**level)
+                    levels.append((lod_filepath(filepath, level),
+                                   lod_splits(base, material_index, tri_verts,
+                                              tri_loops, uvs, num_materials,
+                                              target)))
+        if optimize_cache:
+            # every frame is gathered through the reordered remaps, so st and
+            # the xyznormals of all frames follow the new vertex order
+            misses_before = misses_after = num_triangles = 0
+            with profiler.phase("vertex cache"):
+                for level, (level_path, splits) in enumerate(levels):
+                    splits, before, after = optimize_splits(splits)
+                    levels[level] = (level_path, splits)
+                    misses_before += before
+                    misses_after += after
+                    num_triangles += sum(len(local) for _, local, _ in splits)
+            num_triangles = max(num_triangles, 1)
+            stats["acmr"] = (misses_before/num_triangles,
+                             misses_after/num_triangles)
+            print("Vertex cache ACMR: %.3f -> %.3f" % stats["acmr"])
+
+        mat: bpy.types.Material
+
+        stats["lod_triangles"] = []
+        level_clipped = []
+        for level, (level_path, splits) in enumerate(levels):
+            Surfaces = []
+            # a list so the streamed surfaces can add to it while they are
+            # written
+            clipped = [0]
+            # clipped vertices of every frame of every surface, when
+            # incremental
+            frame_clipped = np.zeros((len(frame_names), num_materials), int)
+
+            # every triangle in mesh vertices, for the normals
+            mesh_triangles = np.concatenate(
+                [remap[local] for remap, local, _ in splits]
+                + [np.empty((0, 3), np.int64)])
+            if bake_range is None and not streaming:
+                # the normals of every frame follow its shape key, baked
+                # frames come with their evaluated normals
+                with profiler.phase("normals"):
+                    nors = vertex_normals(cos, mesh_triangles)
+
+            for num_mat, mat in enumerate(mesh.materials):
+                # store number of node in num_shaders
+
+                num_frames = len(frame_names)
+                num_shaders = len(mat.node_tree.nodes)-2
+                remap, triangles, sts = splits[num_mat]
+                num_verts = len(remap)
+                num_triangles = len(triangles)
+
+                shaders: list[ut.Shader] = []
+
+                if num_shaders > 0:
+                    if mat.node_tree.nodes.get("Image Texture") is not None:
+                        node = mat.node_tree.nodes.get("Image Texture")
+                        #if node.image.filepath start with "//" then use string after "//" as path
+                        if node.image.filepath.startswith("//"):
+                            path = node.image.filepath[2:]
+                        else: 
+                            path = node.image.filepath.rsplit("\\", 1)[1]
                 
-                #print path 
-                print(node.image.filepath)
-                print(path)
-                shaders.append(ut.Shader( path, 0))
-
-            nodes = [ut.Shader(node.name, node.outputs[0].default_value)
-                     for node in mat.node_tree.nodes
-                     if node.bl_idname == 'ShaderNodeValue']
-            shaders.extend(nodes)
-        sts = [None]*num_verts
-        for i, tri in mat_triangles:
-            sts[indexes[id].
-                index(tri[0])] = ut.TexCoord(uv.data[i*3].uv)
-            sts[indexes[id].
-                index(tri[1])] = ut.TexCoord(uv.data[i*3+1].uv)
-
-            sts[indexes[id].
-                index(tri[2])] = ut.TexCoord(uv.data[i*3+2].uv)
-
-        xyzs = []
-        for idx, shape in enumerate(obj.data.shape_keys.key_blocks):
-            shapedata = [None]*num_verts
-            for i in range(len(shape.data)):
-                if i in indexes[num_mat]:
-                    vec = shape.data[i].co
-                    shapedata[indexes[num_mat].index(i)] = ut.Vertex(
-                        int(vec.x/ut.MD3_XYZ_SCALE),
-                        int(vec.y/ut.MD3_XYZ_SCALE),
-                        int(vec.z/ut.MD3_XYZ_SCALE),
-                        obj.data.vertices[i].normal
-                        )
-            xyzs.append(shapedata)
-
-        sur = ut.Surface(IDENT, mat.name.rsplit(".", 1)[0], 0,
-                         num_frames,
-                         num_shaders,
-                         num_verts,
-                         num_triangles,  # num_triangles TODO
-                         0, 0, 0,
-                         0, 0,
-                         shaders,
-                         sur_triangles,  # sur_triangles TODO
-                         sts,
-                         xyzs)  # TODO
-        sur.writeWithoutOFS(exportFile)
-        num_mat += 1
-
-    current_position = exportFile.tell()
-    exportFile.seek(OFS_OFS_EOF)
-    # print("OFS_EOF:", current_position)
-    ut.writeS32(exportFile, current_position)
-    exportFile.seek(current_position)
-
+                        #print path 
+                        print(node.image.filepath)
+                        print(path)
+                        shaders.append(ut.Shader( path, 0))
+
+                    nodes = [ut.Shader(node.name,
+                                       node.outputs[0].default_value)
+                             for node in mat.node_tree.nodes
+                             if node.bl_idname == 'ShaderNodeValue']
+                    shaders.extend(nodes)
+                sts[:, 1] = 1.0 - sts[:, 1]
+
+                if streaming or incremental:
+                    # encoded while they are written
+                    xyzs = np.zeros((0, num_verts, 4), np.int16)
+                else:
+                    with profiler.phase("quantize"):
+                        positions, surface_clipped = quantize(cos[:, remap])
+                        clipped[0] += surface_clipped
+                        xyzs = ut.packVertices(positions, nors[:, remap])
+
+                sur = ut.Surface(ut.MD3_IDENT, mat.name.rsplit(".", 1)[0], 0,
+                                 num_frames,
+                                 num_shaders,
+                                 num_verts,
+                                 num_triangles,  # num_triangles TODO
+                                 0, 0, 0,
+                                 0, 0,
+                                 shaders,
+                                 triangles[:, [0, 2, 1]],
+                                 sts,
+                                 xyzs)
+                if streaming:
+                    sur.setFrameSource(num_frames, num_verts,
+                                       stream_frames(key_blocks,
+                                                     len(mesh.vertices),
+                                                     remap, mesh_triangles,
+                                                     clipped))
+                elif incremental:
+                    # only encoded if the whole file has to be written
+                    sur.setFrameSource(num_frames, num_verts,
+                                       encoded_frames(
+                                           cos, nors, remap,
+                                           frame_clipped[:, num_mat]))
+                Surfaces.append(sur)
+
+            # the offsets are computed from the counts and the whole file is
+            # emitted with a single write, or frame by frame when streaming
+            with profiler.phase("write"):
+                if incremental:
+                    clipped[0] = write_incremental(
+                        level_path, NAME, Frames, Tags, Surfaces, FLAGS, cos,
+                        nors, [remap for remap, _, _ in splits], frame_clipped)
+                else:
+                    with open(level_path, "wb") as exportFile:
+                        ut.writeModel(exportFile, NAME, Frames, Tags, Surfaces,
+                                      FLAGS)
+
+            num_triangles = len(mesh_triangles)
+            stats["lod_triangles"].append(num_triangles)
+            level_clipped.append(clipped[0])
+            if len(levels) > 1:
+                print("LOD %d: %d triangles written to %s"
+                      % (level, num_triangles, level_path))
+    finally:
+        if baked_mesh is not None:
+            bpy.data.meshes.remove(baked_mesh)
+
+    # the levels only use vertices of the full detail, clipped there too
+    clipped = level_clipped[0]
+    if clipped > 0:
+        print("Warning:", clipped, "vertices were clipped to the MD3 range")
     print()
     print("Exporting finished")
     print()
+    return clipped
 
 
 def main(context,
          filepath,
          *,
-         relpath=True,):
+         relpath=True,
+         report=None,
+         use_streaming=False,
+         use_incremental=False,
+         use_profile=False,
+         profile_path="",
+         use_bake=False,
+         frame_start=-1,
+         frame_end=-1,
+         use_vertex_cache=False,
+         lod_levels=0,
+         lod_ratio=0.5,):
     obj = context.object
     if obj is not None and obj.type == 'MESH':
-        export(obj, filepath)
+        bake_range = None
+        if use_bake:
+            # -1 stands for the scene range
+            bake_range = (
+                frame_start if frame_start >= 0 else context.scene.frame_start,
+                frame_end if frame_end >= 0 else context.scene.frame_end)
+        profiler = profile_md3.Profiler(use_profile)
+        stats = {}
+        try:
+            clipped = export(obj, filepath, streaming=use_streaming,
+                             incremental=use_incremental, profiler=profiler,
+                             bake_range=bake_range,
+                             optimize_cache=use_vertex_cache, stats=stats,
+                             lod_levels=lod_levels, lod_ratio=lod_ratio)
+        except ValueError as e:
+            if report is not None:
+                report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+        finally:
+            profiler.stop()
+        if clipped > 0 and report is not None:
+            report({'WARNING'}, "%d vertices were outside the MD3 range "
+                   "and have been clipped" % clipped)
+        if "acmr" in stats and report is not None:
+            report({'INFO'}, "Vertex cache ACMR: %.3f -> %.3f"
+                   % stats["acmr"])
+        if lod_levels > 0 and report is not None:
+            report({'INFO'}, "MD3 LOD triangles: " + ", ".join(
+                str(count) for count in stats["lod_triangles"]))
+        if use_profile:
+            print("MD3 export profile:", profiler.summary())
+            if report is not None:
+                report({'INFO'}, "MD3 export: " + profiler.summary())
+            if profile_path:
+                profiler.dump(bpy.path.abspath(profile_path),
+                              operation="export", files=[filepath])
         return {'FINISHED'}
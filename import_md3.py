@@ -1,11 +1,28 @@
+import os
+import re
 import bpy
-import mathutils
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from numpy.lib.recfunctions import structured_to_unstructured
 from os.path import dirname, join
 from . import Utilities as ut
+from . import lazy_md3
+from . import cache_md3
+from . import profile_md3
+from . import normals as normals_codec
 
 if "ut" in locals():
     import importlib
     importlib.reload(ut)
+    importlib.reload(lazy_md3)
+    importlib.reload(normals_codec)
+
+# enum values of bpy.types.Keyframe.interpolation, for foreach_set
+INTERPOLATION = {'CONSTANT': 0, 'LINEAR': 1, 'BEZIER': 2}
+# action frames of the NLA strip of a single frame clip, short enough that
+# only its own pose is ever shown
+MIN_STRIP_SPAN = 0.01
+
 
 def create_alpha_material(name, image_path) -> bpy.types.Material:
     # print(image_path)
@@ -38,150 +55,379 @@ def create_alpha_material(name, image_path) -> bpy.types.Material:
     return mat
 
 
-def main(context,
-         filepath,
-         *,
-         relpath=None,
-         ):
-    
-    verts: list[mathutils.Vector] = []
-    edges: list = []
-    faces: list = []
-
-    file = open(filepath, "rb")
-    _ = ut.readS32(file)
-    _ = ut.readS32(file)
-
-    NAME = ut.readmax(file, ut.MAX_QPATH)
-    # print(NAME)
-
-    FLAGS = ut.readS32(file)
-    # print("FLAGS : ", FLAGS)
-    NUM_FRAMES = ut.readS32(file)
-    # print("num frames : ", NUM_FRAMES)
-
-    NUM_TAGS = ut.readS32(file)
-    # print("num tags : ", NUM_TAGS)
-
-    NUM_SURFACES = ut.readS32(file)
-    # print("num surfaces :", NUM_SURFACES)
-
-    _ = ut.readS32(file)
-    OFS_FRAMES = ut.readS32(file)
-    OFS_TAGS = ut.readS32(file)
-    OFS_SURFACES = ut.readS32(file)
-    OFS_EOF = ut.readS32(file)
-
-    # print("ofs frames : ", OFS_FRAMES)
-    # print("ofs tags : ", OFS_TAGS)
-    # print("ofs surfaces : ", OFS_SURFACES)
-    # print("ofs eof : ", OFS_EOF)
-
-    file.seek(OFS_FRAMES)
-    Frames: list[ut.Frame] = []
-    for _ in range(min(NUM_FRAMES, ut.MD3_MAX_FRAMES)):
-        Frames.append(ut.Frame.read(file))
-
-    file.seek(OFS_TAGS)
-    Tags: list[ut.Tag] = []
-    for _ in range(min(NUM_TAGS, ut.MD3_MAX_TAGS)):
-        Tags.append(ut.Tag.read(file))
-        # print("ut.Tag name :", Tags[-1].NAME)
-
-    file.seek(OFS_SURFACES)
-    surface: list[ut.Surface] = []
-    for _ in range(min(NUM_SURFACES, ut.MD3_MAX_SURFACES)):
-        surface.append(ut.Surface.read(file, OFS_SURFACES))
-        OFS_SURFACES += surface[-1].OFS_END
-
-    # create the starting model data
-    ofs: int = 0
-    for sur in surface:
-
-        for xy in sur.xyzs[0]:
-            verts.append(mathutils
-                         .Vector((float(xy.x*ut.MD3_XYZ_SCALE),
-                                  float(xy.y*ut.MD3_XYZ_SCALE),
-                                  float(xy.z*ut.MD3_XYZ_SCALE))))
-
-        for tri in sur.triangles:
-            edges.append([tri.indexes[0]+ofs, tri.indexes[1]+ofs])
-            edges.append([tri.indexes[1]+ofs, tri.indexes[2]+ofs])
-            edges.append([tri.indexes[2]+ofs, tri.indexes[0]+ofs])
-
-            faces.append([tri.indexes[0]+ofs, tri.indexes[1]+ofs,
-                          tri.indexes[2]+ofs])
-
-        ofs = ofs + sur.NUM_VERTS
+def surface_positions(surfaces, frame, out) -> np.ndarray:
+    # positions of one frame of every surface, in blender units
+    ofs = 0
+    for sur in surfaces:
+        xyz = sur.frame(frame)
+        np.multiply(xyz[:, :3], ut.MD3_XYZ_SCALE,
+                    out=out[ofs:ofs + sur.NUM_VERTS], casting='unsafe')
+        ofs += sur.NUM_VERTS
+    return out
+
+
+def matrix_quaternions(axes) -> np.ndarray:
+    # (..., 3, 3) rotations, one column per axis -> (..., 4) w, x, y, z,
+    # from the largest component to stay accurate for every rotation
+    m = axes
+    trace = np.stack([1.0 + m[..., 0, 0] + m[..., 1, 1] + m[..., 2, 2],
+                      1.0 + m[..., 0, 0] - m[..., 1, 1] - m[..., 2, 2],
+                      1.0 - m[..., 0, 0] + m[..., 1, 1] - m[..., 2, 2],
+                      1.0 - m[..., 0, 0] - m[..., 1, 1] + m[..., 2, 2]], -1)
+    a = m[..., 2, 1] - m[..., 1, 2]
+    b = m[..., 0, 2] - m[..., 2, 0]
+    c = m[..., 1, 0] - m[..., 0, 1]
+    d = m[..., 0, 1] + m[..., 1, 0]
+    e = m[..., 0, 2] + m[..., 2, 0]
+    g = m[..., 1, 2] + m[..., 2, 1]
+    cases = np.stack([np.stack([trace[..., 0], a, b, c], -1),
+                      np.stack([a, trace[..., 1], d, e], -1),
+                      np.stack([b, d, trace[..., 2], g], -1),
+                      np.stack([c, e, g, trace[..., 3]], -1)], -2)
+    best = np.argmax(trace, -1)[..., None, None]
+    quat = np.take_along_axis(cases, best, -2)[..., 0, :]
+    quat /= np.linalg.norm(quat, axis=-1, keepdims=True)
+    # the same rotation as the previous frame's hemisphere, so that the
+    # curves interpolate the short way
+    if len(quat) > 1:
+        flip = np.sum(quat[1:]*quat[:-1], axis=-1) < 0
+        sign = np.cumprod(np.where(flip, -1.0, 1.0), axis=0)
+        quat[1:] *= sign[..., None]
+    return quat
+
+
+def add_fcurve(action, data_path, index, times, values, group,
+               interpolation='LINEAR'):
+    # the whole curve is set at once, no call per keyframe
+    fcurve = action.fcurves.new(data_path, index=index, action_group=group)
+    points = fcurve.keyframe_points
+    points.add(len(times))
+    co = np.empty((len(times), 2), np.float32)
+    co[:, 0] = times
+    co[:, 1] = values
+    points.foreach_set('co', co.ravel())
+    points.foreach_set('interpolation', np.full(
+        len(times), INTERPOLATION[interpolation], np.int32))
+    fcurve.update()
+    return fcurve
+
+
+def build_tags(obj, tag_array, frames, start,
+               interpolation='LINEAR') -> list:
+    # one empty per tag, parented to obj and animated on the selected
+    # frames, the first one on the scene frame start
+    tag_array = tag_array[frames]
+    origins = structured_to_unstructured(tag_array['ORIGIN'])
+    # the file stores one row per axis
+    quats = matrix_quaternions(np.swapaxes(
+        structured_to_unstructured(tag_array['AXIS_ROTATION']), -1, -2))
+    times = start + np.arange(len(frames))
+    empties = []
+    for num in range(tag_array.shape[1]):
+        name = tag_array[0, num]['NAME'].split(b'\x00', 1)[0] \
+            .decode("utf-8", "replace")
+        empty = bpy.data.objects.new(name, None)
+        empty.empty_display_type = 'ARROWS'
+        empty.parent = obj
+        empty.rotation_mode = 'QUATERNION'
+        bpy.context.scene.collection.objects.link(empty)
+
+        action = bpy.data.actions.new(name + "Action")
+        empty.animation_data_create().action = action
+        for axis in range(3):
+            add_fcurve(action, 'location', axis, times,
+                       origins[:, num, axis], "Location", interpolation)
+        for axis in range(4):
+            add_fcurve(action, 'rotation_quaternion', axis, times,
+                       quats[:, num, axis], "Rotation", interpolation)
+        empty.location = origins[0, num].tolist()
+        empty.rotation_quaternion = quats[0, num].tolist()
+        empties.append(empty)
+    return empties
+
+
+def clip_ranges(names) -> list[tuple[str, int, int]]:
+    # consecutive frames whose names only differ by a trailing number form
+    # a clip: (name, first, last) indexes, "run01", "run02" -> "run"
+    clips = []
+    for idx, name in enumerate(names):
+        base = re.sub(r'[\s_.-]*\d+$', '', name) or "frames"
+        if clips and clips[-1][0] == base:
+            clips[-1][2] = idx
+        else:
+            clips.append([base, idx, idx])
+    return [tuple(clip) for clip in clips]
+
+
+def build_playback(obj, names, start, interpolation='LINEAR', clips='NONE'):
+    # key the eval_time of the absolute shape keys so that every key plays
+    # on its own frame from the scene frame start, the clips found in the
+    # frame names become markers or NLA strips
+    key = obj.data.shape_keys
+    positions = np.empty(len(key.key_blocks), np.float32)
+    key.key_blocks.foreach_get('frame', positions)
+    times = start + np.arange(len(positions))
+
+    action = bpy.data.actions.new(obj.name + "Playback")
+    anim = key.animation_data_create()
+    add_fcurve(action, 'eval_time', 0, times, positions, "Playback",
+               interpolation)
+    anim.action = action
+
+    scene = bpy.context.scene
+    scene.frame_end = max(scene.frame_end, int(times[-1]))
+    if clips == 'MARKERS':
+        for name, first, _ in clip_ranges(names):
+            scene.timeline_markers.new(name, frame=int(times[first]))
+    elif clips == 'NLA':
+        track = anim.nla_tracks.new()
+        track.name = obj.name
+        for name, first, last in clip_ranges(names):
+            # the strip starts with the whole action, then it is cut to
+            # the clip, it ends on its own last key so it never blends
+            # into the first pose of the next clip, a strip can't be empty
+            # so a single frame clip gets the smallest span
+            strip = track.strips.new(name, int(times[first]), action)
+            strip.action_frame_end = float(
+                max(times[last], times[first] + MIN_STRIP_SPAN))
+            strip.action_frame_start = float(times[first])
+        anim.action = None
+    return action
+
+
+def parse_frame_list(text) -> list[int]:
+    # "0, 4, 10-20" -> [0, 4, 10, 11, ..., 20]
+    frames = []
+    for item in text.split(','):
+        item = item.strip()
+        if item:
+            first, _, last = item.partition('-')
+            frames.extend(range(int(first), int(last or first) + 1))
+    return frames
+
+
+def select_frames(num_frames, start=0, end=-1, step=1,
+                  frame_list=None) -> list[int]:
+    # frames to import, an explicit list wins over the range,
+    # end is inclusive and negative for the last frame
+    if frame_list:
+        return [f for f in dict.fromkeys(frame_list) if 0 <= f < num_frames]
+    if end < 0 or end >= num_frames:
+        end = num_frames - 1
+    return list(range(max(start, 0), end + 1, max(step, 1)))
+
+
+def load(filepath, use_cache, profiler):
+    # no blender data is touched, so this can run in a worker thread, only
+    # timed as its allocations would mix with the phases of the main thread
+    with profiler.phase("parse", memory=False):
+        if use_cache:
+            # a file imported before and unchanged on disk is not parsed
+            # again
+            return cache_md3.load(filepath)
+        # only the headers are parsed here, the vertex data of each frame
+        # is read from the mapped file when it is accessed
+        return lazy_md3.LazyMD3(filepath)
+
+
+def build(model, filepath, frames, profiler, import_tags=True,
+          playback='LINEAR', clips='NONE'):
+    # frames: the selected frame numbers, the first one is the basis
+    NAME = model.NAME
+
+    with profiler.phase("header"):
+        Frames: list[ut.Frame] = model.frames
+
+    surface: list = model.surfaces
+
+    # create the starting model data, every attribute is gathered in one
+    # flat array for all surfaces
+
+    with profiler.phase("surfaces"):
+        num_verts = sum(sur.NUM_VERTS for sur in surface)
+        vert_ofs = np.cumsum([0] + [sur.NUM_VERTS for sur in surface])
+        faces = np.concatenate(
+            [sur.triangle_array[:, [0, 2, 1]] + ofs
+             for sur, ofs in zip(surface, vert_ofs)] +
+            [np.empty((0, 3), np.int32)]).astype(np.int32)
+        num_faces = len(faces)
+
+        positions = np.empty((num_verts, 3), np.float32)
+        surface_positions(surface, frames[0], positions)
 
     # Initialize the blender object
 
-    obj_name = NAME.rsplit('.', 1)[0]
-    mesh_data: bpy.types.Mesh = bpy.data.meshes.new(obj_name + "_data")
-    obj: bpy.types.Object = bpy.data.objects.new(obj_name, mesh_data)
-    bpy.context.scene.collection.objects.link(obj)
-    mesh_data.from_pydata(verts, edges, faces)
-
-    # create the shapekeys
-
-    sk_basis = obj.shape_key_add(name=Frames[0].NAME)
-    sk_basis.interpolation = 'KEY_LINEAR'
-    obj.data.shape_keys.use_relative = False
-    for f in range(1, len(Frames)):
-        sk = obj.shape_key_add(name=Frames[f].NAME)
-        sk.interpolation = 'KEY_LINEAR'
-
-        i = 0
-
-        for sur in surface:
-            for xy in sur.xyzs[f]:
-                sk.data[i].co = mathutils.Vector((
-                    float(xy.x*ut.MD3_XYZ_SCALE),
-                    float(xy.y*ut.MD3_XYZ_SCALE),
-                    float(xy.z*ut.MD3_XYZ_SCALE)))
-                i += 1
+    with profiler.phase("mesh"):
+        obj_name = NAME.rsplit('.', 1)[0]
+        mesh_data: bpy.types.Mesh = bpy.data.meshes.new(obj_name + "_data")
+        obj: bpy.types.Object = bpy.data.objects.new(obj_name, mesh_data)
+        bpy.context.scene.collection.objects.link(obj)
+
+        mesh_data.vertices.add(num_verts)
+        mesh_data.vertices.foreach_set('co', positions.ravel())
+        mesh_data.loops.add(num_faces*3)
+        mesh_data.loops.foreach_set('vertex_index', faces.ravel())
+        mesh_data.polygons.add(num_faces)
+        mesh_data.polygons.foreach_set(
+            'loop_start', np.arange(0, num_faces*3, 3, dtype=np.int32))
+        if bpy.app.version < (4, 0, 0):
+            mesh_data.polygons.foreach_set(
+                'loop_total', np.full(num_faces, 3, np.int32))
 
     # Map UV and materials to the mesh
 
-    uv = obj.data.uv_layers.new()
+    with profiler.phase("uvs"):
+        sts = np.concatenate([sur.st_array for sur in surface] +
+                             [np.empty((0, 2), np.float32)])
+        sts[:, 1] = 1.0 - sts[:, 1]
+        uv = mesh_data.uv_layers.new()
+        uv.data.foreach_set('uv', sts[faces.ravel()].ravel())
 
-    i = 0
-    ofs = 0
-    for idx, sur in enumerate(surface):
+    with profiler.phase("mesh"):
+        material_index = np.repeat(
+            np.arange(len(surface), dtype=np.int32),
+            [sur.NUM_TRIANGLES for sur in surface])
+        mesh_data.polygons.foreach_set('material_index', material_index)
+
+        mesh_data.update(calc_edges=True)
 
-        # UV mapping
+    with profiler.phase("materials"):
+        for sur in surface:
 
-        for tri in sur.triangles:
-            uv.data[i].uv = sur.st[tri.indexes[0]].st
-            uv.data[i+1].uv = sur.st[tri.indexes[1]].st
-            uv.data[i+2].uv = sur.st[tri.indexes[2]].st
-            i += 3
+            # Create materials
+            # print(dirname(filepath))
+            path = join(dirname(filepath), sur.shaders[0].name)
+            mat = create_alpha_material(sur.NAME, path)
+            obj.data.materials.append(mat)
+            for sh in sur.shaders[1:]:
+                node = mat.node_tree.nodes.new(type='ShaderNodeValue')
+                node.outputs[0].default_value = sh.shader_index
+                node.name = sh.name
 
-        # Create materials
-        # print(dirname(filepath))
-        path = join(dirname(filepath), sur.shaders[0].name)
-        mat = create_alpha_material(sur.NAME, path)
-        obj.data.materials.append(mat)
-        for sh in sur.shaders[1:]:
-            node = mat.node_tree.nodes.new(type='ShaderNodeValue')
-            node.outputs[0].default_value = sh.VALUE
-            node.name = sh.name
+    # create the shapekeys
 
-        # Assign materials to vertex
-        for t in range(sur.NUM_TRIANGLES):
-            obj.data.polygons[t+ofs].material_index = idx
+    with profiler.phase("shape keys"):
+        # only the selected frames are read, each one straight from its
+        # offset
+        sk_basis = obj.shape_key_add(name=Frames[frames[0]].NAME)
+        sk_basis.interpolation = 'KEY_LINEAR'
+        obj.data.shape_keys.use_relative = False
+        for f in frames[1:]:
+            sk = obj.shape_key_add(name=Frames[f].NAME)
+            sk.interpolation = 'KEY_LINEAR'
+            sk.data.foreach_set('co', surface_positions(surface, f,
+                                                        positions).ravel())
+
+    with profiler.phase("normals"):
+        normals = normals_codec.decodeNormals(np.concatenate(
+            [sur.frame(frames[0])[:, 3] for sur in surface] +
+            [np.empty(0, np.int16)]))
+        obj.data.normals_split_custom_set_from_vertices(normals)
+
+    start = bpy.context.scene.frame_start
+    if playback != 'NONE':
+        with profiler.phase("playback"):
+            build_playback(obj, [Frames[f].NAME for f in frames], start,
+                           playback, clips)
+
+    if import_tags:
+        with profiler.phase("tags"):
+            build_tags(obj, model.tag_array, frames, start,
+                       'LINEAR' if playback == 'NONE' else playback)
+
+    return obj
 
-        ofs += sur.NUM_TRIANGLES
 
-    normals = []
-    vertexes = [sur.xyzs[0] for sur in surface]
-    for v1 in vertexes:
-        for v2 in v1:
-            # print(v2.normal)
-            normals.append(mathutils.Vector([x for x in v2.normal]))
+def main(context,
+         filepath,
+         *,
+         relpath=None,
+         use_cache=True,
+         filepaths=None,
+         report=None,
+         frame_start=0,
+         frame_end=-1,
+         frame_step=1,
+         frame_list="",
+         use_profile=False,
+         profile_path="",
+         import_tags=True,
+         playback='LINEAR',
+         clips='NONE',
+         ):
 
-    obj.data.normals_split_custom_set_from_vertices(normals)
+    try:
+        frame_list = parse_frame_list(frame_list)
+    except ValueError:
+        if report is not None:
+            report({'ERROR'}, "Invalid frame list: %s" % frame_list)
+        return {'CANCELLED'}
+    if frame_list or frame_start > 0 or frame_end >= 0 or frame_step > 1:
+        # the whole model would be loaded into the cache, only the
+        # selected frames are read from the mapped file instead
+        use_cache = False
+
+    # every file is parsed in a thread pool, the objects are built on this
+    # thread in the order the files finish parsing
+    filepaths = filepaths or [filepath]
+    failed = 0
+    profiler = profile_md3.Profiler(use_profile)
+    try:
+        workers = min(len(filepaths), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(load, path, use_cache, profiler): path
+                       for path in filepaths}
+            if profiler.enabled:
+                # tracemalloc traces every thread, the files are all parsed
+                # before the first build so the memory of the build phases
+                # doesn't include the parsing still going on
+                wait(futures)
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    model = future.result()
+                except Exception as e:
+                    failed += 1
+                    print("Could not read", path, ":", e)
+                    if report is not None:
+                        report({'WARNING'},
+                               "Could not read %s: %s" % (path, e))
+                    continue
+                try:
+                    frames = select_frames(len(model.frames), frame_start,
+                                           frame_end, frame_step, frame_list)
+                    if frames:
+                        build(model, path, frames, profiler, import_tags,
+                              playback, clips)
+                    else:
+                        failed += 1
+                        print("No frame selected in", path)
+                        if report is not None:
+                            report({'WARNING'},
+                                   "No frame selected in %s" % path)
+                except Exception as e:
+                    # a broken file doesn't stop the other ones
+                    failed += 1
+                    print("Could not import", path, ":", e)
+                    if report is not None:
+                        report({'WARNING'},
+                               "Could not import %s: %s" % (path, e))
+                finally:
+                    if not use_cache:
+                        model.close()
+    finally:
+        profiler.stop()
+
+    if use_profile:
+        print("MD3 import profile:", profiler.summary())
+        if report is not None:
+            report({'INFO'}, "MD3 import: " + profiler.summary())
+        if profile_path:
+            profiler.dump(bpy.path.abspath(profile_path), operation="import",
+                          files=filepaths)
 
     print("Importing done")
     print()
+    if failed == len(filepaths):
+        return {'CANCELLED'}
     return {'FINISHED'}
\ No newline at end of file
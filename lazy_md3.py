@@ -0,0 +1,129 @@
+import mmap
+
+import numpy as np
+
+try:
+    from . import Utilities as ut
+except ImportError:
+    import Utilities as ut
+
+if "ut" in locals():
+    import importlib
+    importlib.reload(ut)
+
+
+class LazySurface:
+    def __init__(self, buffer, offset) -> None:
+        self.buffer = buffer
+        self.OFFSET: int = offset
+        (self.IDENT, self.NAME, self.FLAGS, self.NUM_FRAMES,
+         self.NUM_SHADERS, self.NUM_VERTS, self.NUM_TRIANGLES,
+         self.OFS_TRIANGLES, self.OFS_SHADERS, self.OFS_ST,
+         self.OFS_XYZNORMAL,
+         self.OFS_END) = ut.Surface.HEADER.unpackFrom(buffer, offset)
+        self._shaders = None
+
+    @property
+    def shaders(self) -> list[ut.Shader]:
+        if self._shaders is None:
+            self._shaders = ut.Shader.unpackArray(
+                self.buffer, self.OFFSET + self.OFS_SHADERS, self.NUM_SHADERS)
+        return self._shaders
+
+    @property
+    def triangle_array(self) -> np.ndarray:
+        return np.frombuffer(self.buffer, ut.TRIANGLE_DTYPE,
+                             self.NUM_TRIANGLES,
+                             self.OFFSET + self.OFS_TRIANGLES) \
+            .view('<i4').reshape(self.NUM_TRIANGLES, 3)
+
+    @property
+    def st_array(self) -> np.ndarray:
+        return np.frombuffer(self.buffer, ut.TEXCOORD_DTYPE, self.NUM_VERTS,
+                             self.OFFSET + self.OFS_ST) \
+            .view('<f4').reshape(self.NUM_VERTS, 2)
+
+    @property
+    def xyz_array(self) -> np.ndarray:
+        return np.frombuffer(self.buffer, ut.VERTEX_DTYPE,
+                             self.NUM_FRAMES * self.NUM_VERTS,
+                             self.OFFSET + self.OFS_XYZNORMAL) \
+            .view('<i2').reshape(self.NUM_FRAMES, self.NUM_VERTS, 4)
+
+    def frame(self, index) -> np.ndarray:
+        # (num_verts, 4) view of x, y, z, normal, nothing is decoded
+        if not 0 <= index < self.NUM_FRAMES:
+            raise IndexError("frame index out of range")
+        ofs = self.OFFSET + self.OFS_XYZNORMAL \
+            + index * self.NUM_VERTS * ut.VERTEX_DTYPE.itemsize
+        return np.frombuffer(self.buffer, ut.VERTEX_DTYPE, self.NUM_VERTS,
+                             ofs).view('<i2').reshape(self.NUM_VERTS, 4)
+
+    def surface(self) -> ut.Surface:
+        # the returned surface shares the mapped memory, frames are only
+        # paged in when they are accessed
+        return ut.Surface(self.IDENT, self.NAME, self.FLAGS, self.NUM_FRAMES,
+                          self.NUM_SHADERS, self.NUM_VERTS,
+                          self.NUM_TRIANGLES, self.OFS_TRIANGLES,
+                          self.OFS_SHADERS, self.OFS_ST, self.OFS_XYZNORMAL,
+                          self.OFS_END, self.shaders, self.triangle_array,
+                          self.st_array, self.xyz_array)
+
+
+class LazyMD3:
+    def __init__(self, filepath) -> None:
+        with open(filepath, "rb") as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.header: ut.Header = ut.Header.unpackFrom(self.buffer)
+        self.NAME: str = self.header.NAME
+        self._frames = None
+        self._tags = None
+
+        # only walk the surface headers, the data stays on disk
+        self.surfaces: list[LazySurface] = []
+        ofs = self.header.OFS_SURFACES
+        for _ in range(min(self.header.NUM_SURFACES, ut.MD3_MAX_SURFACES)):
+            self.surfaces.append(LazySurface(self.buffer, ofs))
+            ofs += self.surfaces[-1].OFS_END
+
+    @property
+    def frames(self) -> list[ut.Frame]:
+        if self._frames is None:
+            num_frames = min(self.header.NUM_FRAMES, ut.MD3_MAX_FRAMES)
+            self._frames = ut.Frame.unpackArray(
+                self.buffer, self.header.OFS_FRAMES, num_frames)
+        return self._frames
+
+    @property
+    def tags(self) -> list[ut.Tag]:
+        # num_tags tags are stored for every frame
+        if self._tags is None:
+            num_tags = min(self.header.NUM_TAGS, ut.MD3_MAX_TAGS) \
+                * len(self.frames)
+            self._tags = ut.Tag.unpackArray(
+                self.buffer, self.header.OFS_TAGS, num_tags)
+        return self._tags
+
+    @property
+    def tag_array(self) -> np.ndarray:
+        # (num_frames, num_tags) TAG_DTYPE view, like MD3Model.tag_array
+        num_tags = min(self.header.NUM_TAGS, ut.MD3_MAX_TAGS)
+        return np.frombuffer(self.buffer, ut.TAG_DTYPE,
+                             len(self.frames)*num_tags,
+                             self.header.OFS_TAGS) \
+            .reshape(len(self.frames), num_tags)
+
+    def close(self):
+        # arrays handed out still reference the mapping, in that case it is
+        # released together with the last of them
+        try:
+            self.buffer.close()
+        except BufferError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
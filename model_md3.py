@@ -0,0 +1,137 @@
+import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
+
+try:
+    from . import Utilities as ut
+    from . import lazy_md3
+except ImportError:
+    import Utilities as ut
+    import lazy_md3
+
+if "ut" in locals():
+    import importlib
+    importlib.reload(ut)
+    importlib.reload(lazy_md3)
+
+
+class MD3Model:
+    # compact in-memory model: frames and tags are structured arrays in file
+    # layout, every surface keeps its triangles, st and xyznormal as arrays,
+    # so the cost per vertex frame is the 8 bytes of the file
+    __slots__ = ('NAME', 'FLAGS', 'frame_array', 'tag_array', 'surfaces')
+
+    def __init__(self, name, flags, frame_array, tag_array, surfaces) -> None:
+        self.NAME: str = name
+        self.FLAGS: int = flags
+        # (num_frames,) FRAME_DTYPE and (num_frames, num_tags) TAG_DTYPE
+        self.frame_array: np.ndarray = frame_array
+        self.tag_array: np.ndarray = tag_array
+        self.surfaces: list[ut.Surface] = surfaces
+
+    @classmethod
+    def fromObjects(cls, name, frames, tags, surfaces, flags=0):
+        # same arguments as Utilities.writeModel
+        num_tags = len(tags)//len(frames) if len(frames) > 0 else 0
+        frame_array = np.frombuffer(
+            b''.join(frame.pack() for frame in frames), ut.FRAME_DTYPE)
+        tag_array = np.frombuffer(
+            b''.join(tag.pack() for tag in tags), ut.TAG_DTYPE) \
+            .reshape(len(frames), num_tags)
+        return cls(name, flags, frame_array, tag_array, list(surfaces))
+
+    def toObjects(self) -> tuple:
+        # (name, frames, tags, surfaces, flags), ready for writeModel
+        return self.NAME, self.frames, self.tags, self.surfaces, self.FLAGS
+
+    @classmethod
+    def fromLazy(cls, model):
+        # copy everything out of a LazyMD3, it can be closed afterwards
+        header = model.header
+        num_frames = min(header.NUM_FRAMES, ut.MD3_MAX_FRAMES)
+        num_tags = min(header.NUM_TAGS, ut.MD3_MAX_TAGS)
+        frame_array = np.frombuffer(model.buffer, ut.FRAME_DTYPE, num_frames,
+                                    header.OFS_FRAMES).copy()
+        tag_array = np.frombuffer(model.buffer, ut.TAG_DTYPE,
+                                  num_frames*num_tags, header.OFS_TAGS) \
+            .reshape(num_frames, num_tags).copy()
+        surfaces = []
+        for lazy in model.surfaces:
+            sur = lazy.surface()
+            sur.triangle_array = sur.triangle_array.copy()
+            sur.st_array = sur.st_array.copy()
+            sur.xyz_array = sur.xyz_array.copy()
+            surfaces.append(sur)
+        return cls(model.NAME, header.FLAGS, frame_array, tag_array, surfaces)
+
+    @classmethod
+    def read(cls, filepath):
+        with lazy_md3.LazyMD3(filepath) as model:
+            return cls.fromLazy(model)
+
+    def write(self, f):
+        ut.writeModel(f, *self.toObjects())
+
+    @property
+    def frames(self) -> list[ut.Frame]:
+        return ut.Frame.unpackArray(self.frame_array.tobytes(), 0,
+                                    self.num_frames)
+
+    @property
+    def tags(self) -> list[ut.Tag]:
+        # num_tags tags for every frame, like LazyMD3.tags
+        return ut.Tag.unpackArray(self.tag_array.tobytes(), 0,
+                                  self.tag_array.size)
+
+    @property
+    def num_frames(self) -> int:
+        return len(self.frame_array)
+
+    @property
+    def num_tags(self) -> int:
+        return self.tag_array.shape[1]
+
+    @property
+    def frame_names(self) -> list[str]:
+        return [name.split(b'\x00', 1)[0].decode("utf-8", "replace")
+                for name in self.frame_array['NAME']]
+
+    @property
+    def min_bounds(self) -> np.ndarray:
+        return structured_to_unstructured(self.frame_array['MIN_BOUNDS'])
+
+    @property
+    def max_bounds(self) -> np.ndarray:
+        return structured_to_unstructured(self.frame_array['MAX_BOUNDS'])
+
+    @property
+    def local_origin(self) -> np.ndarray:
+        return structured_to_unstructured(self.frame_array['LOCAL_ORIGIN'])
+
+    @property
+    def radius(self) -> np.ndarray:
+        return self.frame_array['RADIUS']
+
+    @property
+    def tag_names(self) -> list[str]:
+        # the names of the first frame, they are the same in every frame
+        if self.num_frames == 0:
+            return []
+        return [name.split(b'\x00', 1)[0].decode("utf-8", "replace")
+                for name in self.tag_array[0]['NAME']]
+
+    @property
+    def tag_origin(self) -> np.ndarray:
+        # (num_frames, num_tags, 3)
+        return structured_to_unstructured(self.tag_array['ORIGIN'])
+
+    @property
+    def tag_axis(self) -> np.ndarray:
+        # (num_frames, num_tags, 3, 3), one row per axis
+        return structured_to_unstructured(self.tag_array['AXIS_ROTATION'])
+
+    @property
+    def nbytes(self) -> int:
+        return (self.frame_array.nbytes + self.tag_array.nbytes
+                + sum(sur.triangle_array.nbytes + sur.st_array.nbytes
+                      + sur.xyz_array.nbytes + len(sur.shaders)*ut.Shader.SIZE
+                      for sur in self.surfaces))
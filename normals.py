@@ -0,0 +1,46 @@
+import numpy as np
+
+# MD3 normals are packed in 16 bits, the high byte is the latitude
+# (angle around z) and the low byte the longitude (angle from +z), both
+# in steps of 2*pi/255
+
+NORMAL_STEP: float = 2*np.pi/255.0
+
+
+def buildDecodeTable() -> np.ndarray:
+    packed = np.arange(65536, dtype=np.uint32)
+    lat = ((packed >> 8) & 0xff) * NORMAL_STEP
+    lng = (packed & 0xff) * NORMAL_STEP
+    table = np.empty((65536, 3), np.float32)
+    table[:, 0] = np.cos(lat)*np.sin(lng)
+    table[:, 1] = np.sin(lat)*np.sin(lng)
+    table[:, 2] = np.cos(lng)
+    table.flags.writeable = False
+    return table
+
+
+DECODE_TABLE: np.ndarray = buildDecodeTable()
+
+
+def decodeNormals(packed) -> np.ndarray:
+    # any shape of packed int16 values -> same shape + (3,) float32
+    packed = np.asarray(packed)
+    return DECODE_TABLE[packed.astype(np.uint16, copy=False)]
+
+
+def encodeNormals(normals) -> np.ndarray:
+    # (..., 3) normals -> (...) packed int16, normals don't need to be
+    # unit length, null vectors are encoded as +z
+    normals = np.asarray(normals, np.float64)
+    length = np.linalg.norm(normals, axis=-1)
+    null = length == 0.0
+    z = np.where(null, 1.0, normals[..., 2]/np.where(null, 1.0, length))
+    z = np.clip(z, -1.0, 1.0)
+
+    lng = np.rint(np.arccos(z)/NORMAL_STEP).astype(np.int32)
+    lat = np.rint(np.arctan2(normals[..., 1], normals[..., 0])
+                  / NORMAL_STEP).astype(np.int32) % 255
+    # on the poles the latitude is meaningless, use 0 like the engine does
+    lat = np.where((lng == 0) | (lng >= 128), 0, lat)
+
+    return ((lat << 8) | lng).astype(np.uint16).view(np.int16)
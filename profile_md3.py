@@ -0,0 +1,73 @@
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# shared by every disabled profiler, entering it does nothing
+NO_PHASE = nullcontext()
+
+
+class Profiler:
+    # wall time and traced memory of named phases, a phase entered several
+    # times (once per surface or file) adds up, its peak is the largest
+    def __init__(self, enabled=False, memory=True) -> None:
+        self.enabled: bool = enabled
+        self.memory: bool = enabled and memory
+        self.phases: dict = {}
+        self.lock = threading.Lock()
+        self.started_tracing: bool = False
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+    def phase(self, name, memory=True):
+        # tracemalloc is process wide, phases running in worker threads
+        # alongside others must be timed only with memory=False
+        if not self.enabled:
+            return NO_PHASE
+        return self.measure(name, memory and self.memory)
+
+    @contextmanager
+    def measure(self, name, memory=True):
+        if memory:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if memory:
+                current, peak = tracemalloc.get_traced_memory()
+                allocated = current - before
+                peak -= before
+            with self.lock:
+                entry = self.phases.setdefault(
+                    name, {"seconds": 0.0, "calls": 0})
+                entry["seconds"] += seconds
+                entry["calls"] += 1
+                if memory:
+                    entry["allocated_bytes"] = \
+                        entry.get("allocated_bytes", 0) + allocated
+                    entry["peak_bytes"] = max(entry.get("peak_bytes", 0),
+                                              peak)
+
+    def stop(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def summary(self) -> str:
+        return ", ".join(
+            "%s %.1f ms" % (name, entry["seconds"]*1000)
+            + (" (peak %.1f MB)" % (entry["peak_bytes"]/1e6)
+               if "peak_bytes" in entry else "")
+            for name, entry in self.phases.items())
+
+    def dump(self, path, **info):
+        # one JSON object per run, appended so a file tracks many runs
+        record = dict(info, time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                      phases=self.phases)
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
@@ -0,0 +1,156 @@
+import struct
+
+import numpy as np
+
+# Every MD3 record is little endian, this is the only place where the byte
+# order of the struct codecs is chosen
+
+BYTE_ORDER: str = '<'
+
+
+class String:
+    # fixed size field, zero padded, decoded up to the first zero byte
+    def __init__(self, size) -> None:
+        self.size: int = size
+
+
+class Array:
+    def __init__(self, type, count) -> None:
+        self.type = type
+        self.count: int = count
+
+
+def formatOf(type) -> tuple[str, int]:
+    # struct format of a field and the number of values it unpacks to
+    if isinstance(type, str):
+        return type, 1
+    if isinstance(type, String):
+        return '%ds' % type.size, 1
+    if isinstance(type, Array):
+        fmt, length = formatOf(type.type)
+        return fmt*type.count, length*type.count
+    return type.SCHEMA.format, type.SCHEMA.length
+
+
+def dtypeOf(type):
+    # numpy layout of a field, records nest as structured fields
+    if isinstance(type, str):
+        return BYTE_ORDER + type
+    if isinstance(type, String):
+        return 'S%d' % type.size
+    if isinstance(type, Array):
+        return (dtypeOf(type.type), (type.count,))
+    return type.SCHEMA.dtype
+
+
+def decode(type, flat, i):
+    if isinstance(type, str):
+        return flat[i], i+1
+    if isinstance(type, String):
+        return flat[i].split(b'\x00', 1)[0].decode("utf-8", "replace"), i+1
+    if isinstance(type, Array):
+        values = []
+        for _ in range(type.count):
+            value, i = decode(type.type, flat, i)
+            values.append(value)
+        return values, i
+    values, i = type.SCHEMA.decode(flat, i)
+    return type.fromValues(values), i
+
+
+def encode(type, value, flat):
+    if isinstance(type, str):
+        flat.append(value)
+    elif isinstance(type, String):
+        flat.append(value.encode("utf-8"))
+    elif isinstance(type, Array):
+        for item in value:
+            encode(type.type, item, flat)
+    else:
+        type.SCHEMA.encode(value.values(), flat)
+
+
+class Schema:
+    def __init__(self, *fields) -> None:
+        self.names: list[str] = [name for name, _ in fields]
+        self.types: list = [type for _, type in fields]
+        formats = [formatOf(type) for type in self.types]
+        self.format: str = ''.join(fmt for fmt, _ in formats)
+        self.length: int = sum(length for _, length in formats)
+        self.struct = struct.Struct(BYTE_ORDER + self.format)
+        self.size: int = self.struct.size
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype([(name, dtypeOf(type))
+                         for name, type in zip(self.names, self.types)])
+
+    def decode(self, flat, i=0):
+        values = []
+        for type in self.types:
+            value, i = decode(type, flat, i)
+            values.append(value)
+        return values, i
+
+    def encode(self, values, flat):
+        for type, value in zip(self.types, values):
+            encode(type, value, flat)
+        return flat
+
+    def unpackFrom(self, buf, offset=0) -> list:
+        return self.decode(self.struct.unpack_from(buf, offset))[0]
+
+    def pack(self, values) -> bytes:
+        return self.struct.pack(*self.encode(values, []))
+
+    def packInto(self, buf, offset, values):
+        self.struct.pack_into(buf, offset, *self.encode(values, []))
+
+
+class Record:
+    # subclasses declare SCHEMA, their constructor takes the fields in order,
+    # and __slots__ so that millions of them stay small
+    __slots__ = ()
+    SCHEMA: Schema
+    SIZE: int
+
+    def __init_subclass__(cls) -> None:
+        super().__init_subclass__()
+        cls.SIZE = cls.SCHEMA.size
+
+    @classmethod
+    def fromValues(cls, values):
+        return cls(*values)
+
+    def values(self) -> list:
+        return [getattr(self, name) for name in self.SCHEMA.names]
+
+    @classmethod
+    def fromArray(cls, row):
+        return cls.fromValues(row.tolist())
+
+    @classmethod
+    def unpackFrom(cls, buf, offset=0):
+        return cls.fromValues(cls.SCHEMA.unpackFrom(buf, offset))
+
+    @classmethod
+    def unpackArray(cls, buf, offset, count) -> list:
+        data = memoryview(buf)[offset:offset + count*cls.SIZE]
+        return [cls.fromValues(cls.SCHEMA.decode(flat)[0])
+                for flat in cls.SCHEMA.struct.iter_unpack(data)]
+
+    @classmethod
+    def read(cls, f):
+        data = f.read(cls.SIZE)
+        if len(data) != cls.SIZE:
+            raise EOFError("unexpected end of file while reading MD3 data")
+        return cls.unpackFrom(data)
+
+    def pack(self) -> bytes:
+        return self.SCHEMA.pack(self.values())
+
+    def packInto(self, buf, offset=0):
+        self.SCHEMA.packInto(buf, offset, self.values())
+
+    def write(self, f):
+        f.write(self.pack())
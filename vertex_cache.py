@@ -0,0 +1,151 @@
+from collections import deque
+
+import numpy as np
+
+# Tom Forsyth's linear-speed vertex cache optimisation: the triangles are
+# emitted greedily, the next one is the best scoring triangle using the
+# vertices of the simulated cache, a vertex scores higher the more recently
+# it was used and the fewer triangles it has left
+
+CACHE_SIZE: int = 32
+CACHE_DECAY_POWER: float = 1.5
+LAST_TRIANGLE_SCORE: float = 0.75
+VALENCE_BOOST_SCALE: float = 2.0
+VALENCE_BOOST_POWER: float = 0.5
+
+
+def cacheScores(cache_size=CACHE_SIZE) -> list[float]:
+    # score of a vertex by its position in the cache, the three vertices of
+    # the last triangle share a fixed score so its winding doesn't matter
+    return [LAST_TRIANGLE_SCORE if pos < 3 else
+            (1.0 - (pos - 3)/(cache_size - 3))**CACHE_DECAY_POWER
+            for pos in range(cache_size)]
+
+
+def valenceScores(max_valence) -> list[float]:
+    # boost of a vertex by its number of triangles left, so the lone
+    # triangles are not left behind
+    return [0.0] + [VALENCE_BOOST_SCALE*valence**-VALENCE_BOOST_POWER
+                    for valence in range(1, max_valence + 1)]
+
+
+def forsythOrder(triangles, num_verts, cache_size=CACHE_SIZE) -> np.ndarray:
+    # (T, 3) triangles -> order of the T triangles
+    triangles = np.asarray(triangles).reshape(-1, 3)
+    num_triangles = len(triangles)
+    if num_triangles == 0:
+        return np.empty(0, np.int64)
+    corners = triangles.ravel()
+    valence = np.bincount(corners, minlength=num_verts)
+
+    # the triangles left of every vertex, emitted ones are removed
+    starts = np.concatenate([[0], np.cumsum(valence)]).tolist()
+    by_vertex = (np.argsort(corners, kind='stable')//3).tolist()
+    vertex_triangles = [by_vertex[starts[vert]:starts[vert + 1]]
+                        for vert in range(num_verts)]
+
+    tris = triangles.tolist()
+    remaining = valence.tolist()
+    cache_scores = cacheScores(cache_size)
+    valence_scores = valenceScores(int(valence.max()))
+    vertex_score = [valence_scores[count] for count in remaining]
+    triangle_score = [vertex_score[a] + vertex_score[b] + vertex_score[c]
+                      for a, b, c in tris]
+    emitted = [False]*num_triangles
+
+    order = []
+    cache = []
+    cursor = 0
+    best = max(range(num_triangles), key=triangle_score.__getitem__)
+    while best >= 0:
+        emitted[best] = True
+        order.append(best)
+        tri = tris[best]
+        for vert in tri:
+            remaining[vert] -= 1
+            vertex_triangles[vert].remove(best)
+
+        # the vertices of the triangle move to the front, the ones pushed
+        # out of the cache are rescored too
+        touched = list(dict.fromkeys(tri + cache))
+        cache = touched[:cache_size]
+        for pos, vert in enumerate(touched):
+            score = valence_scores[remaining[vert]]
+            if pos < cache_size:
+                score += cache_scores[pos]
+            delta = score - vertex_score[vert]
+            vertex_score[vert] = score
+            for face in vertex_triangles[vert]:
+                triangle_score[face] += delta
+
+        best = -1
+        best_score = -1.0
+        for vert in cache:
+            for face in vertex_triangles[vert]:
+                if triangle_score[face] > best_score:
+                    best, best_score = face, triangle_score[face]
+        if best < 0:
+            # nothing left around the cache, go on with the first triangle
+            # not emitted yet
+            while cursor < num_triangles and emitted[cursor]:
+                cursor += 1
+            if cursor < num_triangles:
+                best = cursor
+    return np.array(order, np.int64)
+
+
+def firstUseOrder(triangles, num_verts) -> tuple[np.ndarray, np.ndarray]:
+    # vertices in the order the triangles first use them, unused ones last,
+    # returns the new to old vertex map and the renumbered triangles
+    triangles = np.asarray(triangles).reshape(-1, 3)
+    first = np.full(num_verts, triangles.size, np.int64)
+    used, index = np.unique(triangles.ravel(), return_index=True)
+    first[used] = index
+    vertex_order = np.argsort(first, kind='stable')
+    new_index = np.empty(num_verts, np.int64)
+    new_index[vertex_order] = np.arange(num_verts)
+    return vertex_order, new_index[triangles]
+
+
+def optimizeTriangles(triangles, num_verts,
+                      cache_size=CACHE_SIZE) -> tuple[np.ndarray, np.ndarray]:
+    # reordered and renumbered triangles, with the new to old vertex map
+    # every per vertex array has to be indexed with
+    triangles = np.asarray(triangles).reshape(-1, 3)
+    order = forsythOrder(triangles, num_verts, cache_size)
+    return firstUseOrder(triangles[order], num_verts)
+
+
+def cacheMisses(triangles, cache_size=CACHE_SIZE) -> int:
+    # vertices transformed by a FIFO post-transform cache drawing triangles
+    fifo = deque()
+    cached = set()
+    misses = 0
+    for vert in np.asarray(triangles).ravel().tolist():
+        if vert in cached:
+            continue
+        misses += 1
+        if len(fifo) == cache_size:
+            cached.discard(fifo.popleft())
+        fifo.append(vert)
+        cached.add(vert)
+    return misses
+
+
+def acmr(triangles, cache_size=CACHE_SIZE) -> float:
+    # average cache miss ratio, transformed vertices per triangle, from 3
+    # at worst down to about 0.5 on large regular meshes
+    num_triangles = np.asarray(triangles).size//3
+    if num_triangles == 0:
+        return 0.0
+    return cacheMisses(triangles, cache_size)/num_triangles
+
+
+def optimizeSurface(sur, cache_size=CACHE_SIZE):
+    # reorders a surface holding its arrays in place, st and the xyznormal
+    # of every frame follow the new vertex numbers
+    vertex_order, triangles = optimizeTriangles(
+        sur.triangle_array, len(sur.st_array), cache_size)
+    sur.triangle_array = triangles.astype('<i4')
+    sur.st_array = sur.st_array[vertex_order]
+    sur.xyz_array = sur.xyz_array[:, vertex_order]